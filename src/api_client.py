@@ -7,6 +7,14 @@ from typing import List, Optional, Dict, Any
 import base64
 from io import BytesIO
 
+from .cassette import (
+    RecordingImageClient,
+    RecordingTextClient,
+    ReplayImageClient,
+    ReplayTextClient,
+    get_active_cassette,
+)
+
 # --- Gemini API configuration ---
 def configure_gemini_api() -> None:
     """配置 Gemini API（Google 官方 SDK）"""
@@ -23,6 +31,8 @@ def get_text_provider() -> str:
 class TextClient:
     def __init__(self):
         self.model = None
+        # total_token_count of the last call (from usage_metadata), None if unknown
+        self.last_token_count: Optional[int] = None
         self._configure_model()
 
     def _configure_model(self):
@@ -32,15 +42,29 @@ class TextClient:
             raise ValueError("TEXT_MODEL environment variable not set.")
         self.model = genai.GenerativeModel(model_name)
 
-    def generate_text(self, prompt: str) -> str:
+    def generate_text(self, prompt: str, response_schema: Optional[Dict[str, Any]] = None) -> str:
         """
         Generates text using the configured Gemini model.
         The prompt should already contain the narrative text to be analyzed.
+
+        If `response_schema` is given, the model is asked for JSON output
+        constrained to that schema (OpenAPI subset, see panel_schema.py).
         """
         if not self.model:
             self._configure_model()
         try:
-            response = self.model.generate_content(prompt)
+            if response_schema is not None:
+                response = self.model.generate_content(
+                    prompt,
+                    generation_config={
+                        "response_mime_type": "application/json",
+                        "response_schema": response_schema,
+                    },
+                )
+            else:
+                response = self.model.generate_content(prompt)
+            usage = getattr(response, "usage_metadata", None)
+            self.last_token_count = getattr(usage, "total_token_count", None)
             return response.text
         except Exception as e:
             print(f"Error generating text: {e}")
@@ -51,7 +75,13 @@ _text_client_instance = None
 def get_text_client() -> TextClient:
     global _text_client_instance
     if _text_client_instance is None:
-        _text_client_instance = TextClient()
+        cassette = get_active_cassette()
+        if cassette is not None and cassette.mode == "replay":
+            _text_client_instance = ReplayTextClient(cassette)
+        elif cassette is not None:
+            _text_client_instance = RecordingTextClient(TextClient(), cassette)
+        else:
+            _text_client_instance = TextClient()
     return _text_client_instance
 
 # --- ImageClient implementation for Doubao ---
@@ -177,5 +207,11 @@ _image_client_instance = None
 def get_image_client() -> ImageClient:
     global _image_client_instance
     if _image_client_instance is None:
-        _image_client_instance = ImageClient()
+        cassette = get_active_cassette()
+        if cassette is not None and cassette.mode == "replay":
+            _image_client_instance = ReplayImageClient(cassette)
+        elif cassette is not None:
+            _image_client_instance = RecordingImageClient(ImageClient(), cassette)
+        else:
+            _image_client_instance = ImageClient()
     return _image_client_instance
\ No newline at end of file
@@ -0,0 +1,332 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# === Provider 流量录制 / 回放（cassette） ===
+#
+# record 模式：TextClient / ImageClient 的每次请求和响应（包括生成的图片字节）
+#              都写进一个 cassette 文件（单个 SQLite 文件，请求/响应 zlib 压缩，
+#              图片按 sha256 去重存储，按请求 key 建索引）。
+# replay 模式：完全离线，从 cassette 里按请求 key 取回响应，不需要任何 API Key。
+#   - strict : 请求内容（prompt + 所有参数）必须完全一致
+#   - lenient: 先按完全一致匹配，再按「空白归一化后的 prompt」匹配，
+#              最后按 response_schema 相同的请求的录制顺序依次返回（适合只改了 prompt 模板措辞的情况）；
+#              非完全一致的命中都会打印 [WARN]
+#
+# 配置方式：
+#   CLI:  --record-cassette PATH / --replay-cassette PATH [--cassette-match lenient]
+#   环境变量: PROVIDER_CASSETTE=PATH  PROVIDER_CASSETTE_MODE=record|replay
+#             PROVIDER_CASSETTE_MATCH=strict|lenient
+#
+# 同一个 cassette 多次 record 会追加；想重新录制请先删除文件。
+
+CASSETTE_MODES = ("record", "replay")
+MATCH_MODES = ("strict", "lenient")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    strict_key TEXT NOT NULL,
+    lenient_key TEXT NOT NULL,
+    schema_key TEXT,
+    request BLOB NOT NULL,
+    response BLOB NOT NULL,
+    payload_sha TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_interactions_strict ON interactions (kind, strict_key, id);
+CREATE INDEX IF NOT EXISTS ix_interactions_lenient ON interactions (kind, lenient_key, id);
+CREATE TABLE IF NOT EXISTS payloads (
+    sha TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class CassetteMiss(LookupError):
+    """replay 模式下找不到对应的录制记录。"""
+
+
+def _pack(obj: Any) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+
+def _unpack(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def _digest(obj: Any) -> str:
+    raw = json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _normalize_prompt(prompt: str) -> str:
+    return _WHITESPACE_RE.sub(" ", prompt).strip()
+
+
+class Cassette:
+    def __init__(self, path: str | Path, mode: str, match: str = "strict"):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode: {mode!r} (expected one of {CASSETTE_MODES})")
+        if match not in MATCH_MODES:
+            raise ValueError(f"Unknown cassette match mode: {match!r} (expected one of {MATCH_MODES})")
+
+        self.path = Path(path)
+        self.mode = mode
+        self.match = match
+
+        if mode == "replay" and not self.path.exists():
+            raise FileNotFoundError(f"Cassette file not found: {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        self._conn.commit()
+
+        # replay 时已经用过的记录 id，相同请求按录制顺序依次返回
+        self._used_ids: set[int] = set()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _migrate(self) -> None:
+        """旧版 cassette 没有 schema_key 列：补上列并按已录制的请求回填。"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(interactions)")}
+        if "schema_key" not in columns:
+            self._conn.execute("ALTER TABLE interactions ADD COLUMN schema_key TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_interactions_schema ON interactions (kind, schema_key, id)")
+        rows = self._conn.execute("SELECT id, request FROM interactions WHERE schema_key IS NULL").fetchall()
+        for row_id, request_blob in rows:
+            self._conn.execute(
+                "UPDATE interactions SET schema_key = ? WHERE id = ?",
+                (self.request_keys(_unpack(request_blob))[2], row_id),
+            )
+
+    # --- keys ---
+
+    @staticmethod
+    def request_keys(request: Dict[str, Any]) -> tuple[str, str, str]:
+        """返回 (strict_key, lenient_key, schema_key)；schema_key 只看 response_schema，用于限定宽松匹配的范围。"""
+        strict_key = _digest(request)
+        lenient_key = _digest({"prompt": _normalize_prompt(request.get("prompt", ""))})
+        schema_key = _digest({"response_schema": request.get("response_schema")})
+        return strict_key, lenient_key, schema_key
+
+    # --- record ---
+
+    def record(
+        self,
+        kind: str,
+        request: Dict[str, Any],
+        response: Dict[str, Any],
+        payload: Optional[bytes] = None,
+    ) -> None:
+        strict_key, lenient_key, schema_key = self.request_keys(request)
+        payload_sha = hashlib.sha256(payload).hexdigest() if payload is not None else None
+        with self._lock:
+            if payload is not None:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO payloads (sha, data) VALUES (?, ?)",
+                    (payload_sha, sqlite3.Binary(payload)),
+                )
+            self._conn.execute(
+                "INSERT INTO interactions"
+                " (kind, strict_key, lenient_key, schema_key, request, response, payload_sha, recorded_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, strict_key, lenient_key, schema_key, _pack(request), _pack(response), payload_sha, time.time()),
+            )
+            self._conn.commit()
+
+    # --- replay ---
+
+    def lookup(self, kind: str, request: Dict[str, Any]) -> tuple[Dict[str, Any], Optional[bytes]]:
+        strict_key, lenient_key, schema_key = self.request_keys(request)
+        # (匹配方式, 额外条件, 是否按录制顺序兜底)；宽松匹配都要求 response_schema 相同
+        queries = [("exact", {"strict_key": strict_key}, False)]
+        if self.match == "lenient":
+            queries.append(("normalized prompt", {"lenient_key": lenient_key, "schema_key": schema_key}, False))
+            queries.append(("recording order", {"schema_key": schema_key}, True))
+
+        preview = _normalize_prompt(request.get("prompt", ""))[:60]
+        with self._lock:
+            for how, conditions, ordered in queries:
+                row = self._next_unused(kind, conditions, ordered)
+                if row is None:
+                    continue
+                row_id, response_blob, payload_sha = row
+                self._used_ids.add(row_id)
+                payload = None
+                if payload_sha:
+                    payload_row = self._conn.execute(
+                        "SELECT data FROM payloads WHERE sha = ?", (payload_sha,)
+                    ).fetchone()
+                    payload = bytes(payload_row[0]) if payload_row else None
+                if how != "exact":
+                    print(f"[WARN] Cassette served {kind} interaction #{row_id} by {how} (not an exact match) "
+                          f"for prompt: {preview}...")
+                return _unpack(response_blob), payload
+
+        raise CassetteMiss(
+            f"No recorded {kind} interaction in {self.path} ({self.match} match) for prompt: {preview}..."
+        )
+
+    def _next_unused(self, kind: str, conditions: Dict[str, str], ordered: bool):
+        where = " AND ".join(f"{column} = ?" for column in conditions)
+        rows = self._conn.execute(
+            f"SELECT id, response, payload_sha FROM interactions WHERE kind = ? AND {where} ORDER BY id",
+            (kind, *conditions.values()),
+        ).fetchall()
+        if not rows:
+            return None
+        for row in rows:
+            if row[0] not in self._used_ids:
+                return row
+        # 同一请求被调用的次数比录制的多：按 key 匹配时重复最后一条；顺序兜底时视为没有
+        return rows[-1] if not ordered else None
+
+
+# --- 客户端包装 ---
+
+class RecordingTextClient:
+    """包装真实 TextClient，把每次请求/响应写进 cassette。"""
+
+    def __init__(self, inner: Any, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+
+    def generate_text(self, prompt: str, response_schema: Optional[Dict[str, Any]] = None) -> str:
+        text = self.inner.generate_text(prompt=prompt, response_schema=response_schema)
+        self.cassette.record(
+            "text",
+            {"prompt": prompt, "response_schema": response_schema},
+            {"text": text, "token_count": getattr(self.inner, "last_token_count", None)},
+        )
+        return text
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+
+class ReplayTextClient:
+    """离线回放 TextClient，不需要 GOOGLE_API_KEY / TEXT_MODEL。"""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.last_token_count: Optional[int] = None
+
+    def generate_text(self, prompt: str, response_schema: Optional[Dict[str, Any]] = None) -> str:
+        response, _ = self.cassette.lookup("text", {"prompt": prompt, "response_schema": response_schema})
+        self.last_token_count = response.get("token_count")
+        return response["text"]
+
+
+def _image_request(prompt: str, reference_images: Optional[List[str]], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    # output_path 只是本地保存位置，不算请求内容
+    return {"prompt": prompt, "reference_images": list(reference_images or []), "params": kwargs}
+
+
+class RecordingImageClient:
+    """包装真实 ImageClient，把请求参数和生成的图片字节写进 cassette。"""
+
+    def __init__(self, inner: Any, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+
+    def generate_image(
+        self,
+        prompt: str,
+        output_path: Optional[str] = None,
+        reference_images: Optional[list[str]] = None,
+        **kwargs,
+    ) -> Optional[str]:
+        result = self.inner.generate_image(
+            prompt, output_path=output_path, reference_images=reference_images, **kwargs
+        )
+        request = _image_request(prompt, reference_images, kwargs)
+
+        if result and output_path and result == output_path and os.path.exists(output_path):
+            with open(output_path, "rb") as f:
+                payload = f.read()
+            self.cassette.record("image", request, {"type": "file"}, payload)
+        elif result:
+            self.cassette.record("image", request, {"type": "url", "value": result})
+        else:
+            self.cassette.record("image", request, {"type": "none"})
+        return result
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+
+class ReplayImageClient:
+    """离线回放 ImageClient，图片字节直接从 cassette 写到 output_path。"""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+
+    def generate_image(
+        self,
+        prompt: str,
+        output_path: Optional[str] = None,
+        reference_images: Optional[list[str]] = None,
+        **kwargs,
+    ) -> Optional[str]:
+        response, payload = self.cassette.lookup("image", _image_request(prompt, reference_images, kwargs))
+
+        if response["type"] == "url":
+            return response["value"]
+        if response["type"] == "none" or payload is None:
+            return None
+        if not output_path:
+            print("Replayed image has bytes, but no output_path provided to save it.")
+            return None
+
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(payload)
+        print(f"[CASSETTE] Replayed image saved to {output_path}")
+        return output_path
+
+
+# --- 全局 cassette（由 CLI 或环境变量配置） ---
+
+_active_cassette: Optional[Cassette] = None
+_configured = False
+
+
+def activate_cassette(path: str | Path, mode: str, match: str = "strict") -> Cassette:
+    """启用 cassette；需要在第一次 get_text_client() / get_image_client() 之前调用。"""
+    global _active_cassette, _configured
+    _active_cassette = Cassette(path, mode, match)
+    _configured = True
+    print(f"[INFO] Provider cassette: {mode} ({match}) -> {_active_cassette.path}")
+    return _active_cassette
+
+
+def get_active_cassette() -> Optional[Cassette]:
+    """返回当前 cassette；没通过 activate_cassette 配置时读取 PROVIDER_CASSETTE* 环境变量。"""
+    global _configured
+    if not _configured:
+        _configured = True
+        path = os.getenv("PROVIDER_CASSETTE")
+        if path:
+            activate_cassette(
+                path,
+                os.getenv("PROVIDER_CASSETTE_MODE", "replay"),
+                os.getenv("PROVIDER_CASSETTE_MATCH", "strict"),
+            )
+    return _active_cassette
@@ -0,0 +1,238 @@
+from __future__ import annotations
+import json
+import mmap
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# === 长篇小说章节索引 ===
+#
+# 对 UTF-8 小说文件做内存映射（mmap），按「第X章 / 第X回」标题扫描一次，
+# 记录每章的字节偏移，并把索引缓存在源文件旁边：
+#     data/novel.txt  ->  data/novel.txt.chapters.json
+# 源文件的 mtime / size 变化时缓存自动失效。
+# 之后按章节读取时只 decode 需要的那几段字节，不再整本 read_text()。
+
+INDEX_VERSION = 3
+INDEX_SUFFIX = ".chapters.json"
+
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+_CN_DIGITS = {
+    "零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4,
+    "五": 5, "六": 6, "七": 7, "八": 8, "九": 9,
+}
+_CN_UNITS = {"十": 10, "百": 100, "千": 1000}
+_FULLWIDTH_DIGITS = str.maketrans("０１２３４５６７８９", "0123456789")
+
+# bytes 正则里不能直接用多字节字符做字符类，只能写成交替分支
+_NUMERAL_ALT = "|".join(list(_CN_DIGITS) + list(_CN_UNITS) + ["万"] + list("０１２３４５６７８９"))
+_HEADING_RE = re.compile(
+    (
+        r"(?m)^(?:[ \t]|　)*"
+        # 「第一回合……」是正文不是标题；网文常见的「第1章风起」标题直接跟在「章」后面
+        r"(第((?:[0-9]|" + _NUMERAL_ALT + r")+)(?:章|回(?!合)))"
+        r"([^\r\n]*)\r?$"
+    ).encode("utf-8")
+)
+
+
+def _parse_chapter_number(token: str) -> Optional[int]:
+    """把「一百二十」「120」「１２０」「一二〇」之类的章节号转成 int，失败返回 None。"""
+    token = token.translate(_FULLWIDTH_DIGITS)
+    if token.isdigit():
+        return int(token)
+
+    # 没有单位字（一二〇）时按逐位数字处理
+    if not any(ch in _CN_UNITS or ch == "万" for ch in token):
+        digits = [_CN_DIGITS.get(ch) for ch in token]
+        if any(d is None for d in digits):
+            return None
+        return int("".join(str(d) for d in digits))
+
+    total, section, digit = 0, 0, 0
+    for ch in token:
+        if ch in _CN_DIGITS:
+            digit = _CN_DIGITS[ch]
+        elif ch in _CN_UNITS:
+            section += (digit or 1) * _CN_UNITS[ch]
+            digit = 0
+        elif ch == "万":
+            total += (section + digit) * 10000
+            section, digit = 0, 0
+        else:
+            return None
+    return total + section + digit
+
+
+def index_path_for(novel_path: str | Path) -> Path:
+    """返回小说文件对应的索引缓存路径（与源文件同目录）。"""
+    novel_path = Path(novel_path)
+    return novel_path.with_name(novel_path.name + INDEX_SUFFIX)
+
+
+def build_chapter_index(novel_path: str | Path) -> List[Dict[str, Any]]:
+    """
+    扫描小说文件，返回章节列表（不读缓存、不写缓存）。
+
+    每个元素形如：
+    {
+        "ordinal": 1,          # 在文件中的顺序，从 1 开始；正文前的内容为 0
+        "number": 120,         # 从标题解析出的章节号，解析失败为 None
+        "title": "第一百二十章 夜航",
+        "start": 10240,        # 字节偏移（含标题行）
+        "end": 20480,
+    }
+    """
+    novel_path = Path(novel_path)
+    size = novel_path.stat().st_size
+    if size == 0:
+        return []
+
+    chapters: List[Dict[str, Any]] = []
+    with novel_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        body_start = len(_UTF8_BOM) if mm[:3] == _UTF8_BOM else 0
+
+        # 在跳过 BOM 后的视图上匹配：finditer(mm, pos) 时 (?m)^ 不会匹配 pos 本身，
+        # 文件开头的第一个标题会被漏掉；偏移量再加回 body_start
+        with memoryview(mm)[body_start:] as body:
+            headings = [
+                (m.start() + body_start, bytes(m.group(0)), bytes(m.group(2)))
+                for m in _HEADING_RE.finditer(body)
+            ]
+
+        # 第一个标题之前如果还有正文（书名、楔子等），记成第 0 章
+        first_start = headings[0][0] if headings else size
+        if mm[body_start:first_start].strip():
+            chapters.append({
+                "ordinal": 0,
+                "number": 0,
+                "title": "",
+                "start": body_start,
+                "end": first_start,
+            })
+
+        for i, (start, heading, numeral) in enumerate(headings):
+            end = headings[i + 1][0] if i + 1 < len(headings) else size
+            title = heading.decode("utf-8", errors="replace").strip()
+            number = _parse_chapter_number(numeral.decode("utf-8", errors="replace"))
+            chapters.append({
+                "ordinal": i + 1,
+                "number": number,
+                "title": title,
+                "start": start,
+                "end": end,
+            })
+
+    return chapters
+
+
+def load_chapter_index(novel_path: str | Path) -> List[Dict[str, Any]]:
+    """
+    读取章节索引：缓存有效（mtime / size 与源文件一致）就直接用，否则重新扫描并写回缓存。
+    """
+    novel_path = Path(novel_path)
+    if not novel_path.exists():
+        raise FileNotFoundError(f"找不到小说文件: {novel_path}")
+
+    st = novel_path.stat()
+    cache_path = index_path_for(novel_path)
+
+    if cache_path.exists():
+        try:
+            cached = json.loads(cache_path.read_text(encoding="utf-8"))
+            if (
+                cached.get("version") == INDEX_VERSION
+                and cached.get("source_size") == st.st_size
+                and cached.get("source_mtime_ns") == st.st_mtime_ns
+            ):
+                return cached["chapters"]
+        except (ValueError, KeyError) as e:
+            print(f"[WARN] 章节索引缓存损坏，重新构建: {cache_path} ({e})")
+
+    chapters = build_chapter_index(novel_path)
+    payload = {
+        "version": INDEX_VERSION,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "chapters": chapters,
+    }
+    try:
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # 源文件所在目录只读时照样可以用，只是每次都要重新扫描
+        print(f"[WARN] 无法写入章节索引缓存 {cache_path}: {e}")
+
+    print(f"[INFO] Built chapter index for {novel_path.name}: {len(chapters)} sections")
+    return chapters
+
+
+def parse_chapter_selection(spec: str) -> List[Tuple[int, int]]:
+    """
+    解析命令行的章节选择，例如 "120-135"、"3"、"1-5,8,10-12"，
+    返回闭区间列表 [(120, 135)]。
+    """
+    ranges: List[Tuple[int, int]] = []
+    for part in spec.replace("，", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo_s, hi_s = part.split("-", 1)
+            lo, hi = int(lo_s), int(hi_s)
+        else:
+            lo = hi = int(part)
+        if lo > hi:
+            raise ValueError(f"章节范围写反了: {part}")
+        ranges.append((lo, hi))
+    if not ranges:
+        raise ValueError(f"无效的章节选择: {spec!r}")
+    return ranges
+
+
+def select_chapters(chapters: List[Dict[str, Any]], spec: str) -> List[Dict[str, Any]]:
+    """按章节号筛选索引项；标题里的章节号解析失败时退回用 ordinal。"""
+    ranges = parse_chapter_selection(spec)
+    selected = []
+    for ch in chapters:
+        number = ch["number"] if ch["number"] is not None else ch["ordinal"]
+        if any(lo <= number <= hi for lo, hi in ranges):
+            selected.append(ch)
+    return selected
+
+
+def read_chapters(novel_path: str | Path, spec: str | None = None) -> str:
+    """
+    读取小说文本。
+
+    spec 为 None 时读取全文；否则只通过 mmap 切出选中章节的字节再 decode，
+    例如 read_chapters("data/novel.txt", "120-135")。
+    """
+    novel_path = Path(novel_path)
+    if spec is None:
+        if not novel_path.exists():
+            raise FileNotFoundError(f"找不到小说文件: {novel_path}")
+        return novel_path.read_text(encoding="utf-8-sig")
+
+    chapters = load_chapter_index(novel_path)
+    selected = select_chapters(chapters, spec)
+    if not selected:
+        raise ValueError(
+            f"在 {novel_path} 中没有找到章节 {spec}（共索引到 {len(chapters)} 段）。"
+        )
+
+    # 相邻章节合并成一段，减少切片次数
+    spans: List[List[int]] = []
+    for ch in sorted(selected, key=lambda c: c["start"]):
+        if spans and spans[-1][1] == ch["start"]:
+            spans[-1][1] = ch["end"]
+        else:
+            spans.append([ch["start"], ch["end"]])
+
+    with novel_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        parts = [mm[start:end].decode("utf-8") for start, end in spans]
+
+    return "\n".join(part.rstrip("\r\n") for part in parts) + "\n"
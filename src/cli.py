@@ -4,9 +4,22 @@ import json
 import yaml
 import argparse
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 
 from . import comic_generator
+from .api_client import get_text_client
+from .cassette import MATCH_MODES, activate_cassette
+from .chapter_index import read_chapters
+from .scene_dedup import SceneIndex
+from .scheduler import (
+    PROMPT_TEMPLATE_TOKENS,
+    PanelScheduler,
+    RunBudget,
+    estimate_tokens,
+    parse_priority_weights,
+)
+from .thumbnails import build_contact_sheet, collect_panel_images, default_cache_dir
+from .work_queue import PanelWorkQueue, default_queue_path, export_results, run_worker
 # 🔥 load_reference_images()
 
 from typing import Dict
@@ -44,10 +57,10 @@ def load_reference_images(project_root: Path) -> Dict[str, str]:
     return ref
 
 
-def step1_export_comic_panels(project_root: Path):
+def step1_export_comic_panels(project_root: Path, chapters: Optional[str] = None):
     """
     第一步：
-    - 只从 data/novel.txt 中加载小说文本
+    - 只从 data/novel.txt 中加载小说文本（指定 chapters 时只读取这些章节）
     - 调用 parse_novel_to_comic_panels 得到【纯文字分镜数据】
     - 保存为 YAML，方便人工修改
     """
@@ -58,8 +71,11 @@ def step1_export_comic_panels(project_root: Path):
     if not novel_path.exists():
         raise FileNotFoundError(f"找不到小说文件: {novel_path}")
 
-    print(f"Loading novel text from: {novel_path}")
-    novel_text = novel_path.read_text(encoding="utf-8")
+    if chapters:
+        print(f"Loading chapters {chapters} from: {novel_path}")
+    else:
+        print(f"Loading novel text from: {novel_path}")
+    novel_text = read_chapters(novel_path, chapters)
     print(f"Loaded novel text (length: {len(novel_text)} chars).")
 
     # 不再依赖角色图 / 术语图，先传空列表即可
@@ -86,11 +102,23 @@ def step1_export_comic_panels(project_root: Path):
     print("你现在可以去手动编辑这个 YAML，再执行 step 2 生成图片提示。")
 
 
-def step2_generate_image_descriptions(project_root: Path, panels_yaml_path: Optional[str] = None):
+def step2_generate_image_descriptions(
+    project_root: Path,
+    panels_yaml_path: Optional[str] = None,
+    chapters: Optional[str] = None,
+    dedup_threshold: Optional[float] = None,
+    scheduler: Optional[PanelScheduler] = None,
+    resume: bool = False,
+    resources: Optional[Tuple[str, Dict[str, str], Dict[str, str]]] = None,
+):
     """
     第二步：
     - 读取已经人工修改好的分镜 YAML
     - 为每个 panel 生成 generated_image_description
+      （指定 dedup_threshold 时，与之前 panel 近似重复的场景直接复用已有描述）
+    - 指定 scheduler 时按优先级顺序处理，token / 时间预算用完就停下并写出报告
+    - resume=True 时沿用上次 generated_comic_data.json 中已生成（且场景未修改）的描述
+    - resources 为 load_all_resources 的返回值，调用方已缓存时传入（常驻服务模式），否则现读
     - 保存为 JSON（或你想要的其他格式）
     """
     print("=== STEP 2: 从分镜文档生成图片提示 ===")
@@ -114,17 +142,86 @@ def step2_generate_image_descriptions(project_root: Path, panels_yaml_path: Opti
     if not isinstance(comic_panels_data, list):
         raise ValueError("YAML 中的分镜数据应为一个 list，每个元素为一个 panel 的 dict。")
 
+    output_dir = project_root / 'output'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file_path = output_dir / 'generated_comic_data.json'
+
+    # 只有 --resume 时才沿用上次的描述；否则 YAML 里残留的描述字段一律重新生成
+    description_keys = ('generated_image_description', 'dedup_source_panel', 'dedup_similarity')
+    for panel in comic_panels_data:
+        for key in description_keys:
+            panel.pop(key, None)
+
+    carried: set = set()
+    if resume and output_file_path.exists():
+        with output_file_path.open('r', encoding='utf-8') as f:
+            previous = {
+                p.get('panel_number'): p
+                for p in json.load(f)
+                if p.get('generated_image_description')
+            }
+        for i, panel in enumerate(comic_panels_data):
+            panel_number = panel.get('panel_number', i + 1)
+            prev = previous.get(panel_number)
+            if prev and prev.get('scene_description') == panel.get('scene_description'):
+                for key in description_keys:
+                    if key in prev:
+                        panel[key] = prev[key]
+                carried.add(panel_number)
+        print(f"Resuming: reused {len(carried)} image descriptions from {output_file_path}")
+
     # 再次加载资源（主要是角色图像 / 术语图像，用于辅助生成描述）
     print("Loading character and term images for image description generation...")
-    novel_text, character_images, term_images = comic_generator.load_all_resources(project_root)
+    if resources is None:
+        resources = comic_generator.load_all_resources(project_root, chapters)
+    novel_text, character_images, term_images = resources
     print(f"Loaded {len(character_images)} character images.")
     print(f"Loaded {len(term_images)} term images.")
 
     print("Generating image descriptions for each comic panel...")
-    full_comic_data = []
 
-    for i, panel in enumerate(comic_panels_data):
+    # 近似重复场景索引：只收录真正调用过 LLM 的 panel，复用关系始终指向原始 panel
+    scene_index = SceneIndex(dedup_threshold) if dedup_threshold else None
+    descriptions_by_panel: Dict[Any, str] = {}
+    reused = 0
+
+    ordered = scheduler.order(comic_panels_data) if scheduler is not None else list(enumerate(comic_panels_data))
+    completed: List[Any] = []
+    remaining: List[Any] = []
+    stopped_reason: Optional[str] = None
+
+    for i, panel in ordered:
         panel_number = panel.get('panel_number', i + 1)
+
+        if panel_number in carried:
+            # --resume 沿用的描述，不再调用 LLM
+            if scene_index is not None and 'dedup_source_panel' not in panel:
+                scene_index.add(panel_number, panel)
+                descriptions_by_panel[panel_number] = panel['generated_image_description']
+            continue
+
+        match = scene_index.query(panel) if scene_index is not None else None
+        if match is not None:
+            # 复用已有描述不花预算，预算用完后也照常处理
+            source_number, similarity = match
+            panel['generated_image_description'] = descriptions_by_panel[source_number]
+            panel['dedup_source_panel'] = source_number
+            panel['dedup_similarity'] = round(similarity, 3)
+            completed.append(panel_number)
+            reused += 1
+            print(f"Panel {panel_number} is a near-duplicate of panel {source_number} "
+                  f"(similarity {similarity:.2f}), reusing its image description.")
+            continue
+
+        if stopped_reason is not None:
+            remaining.append(panel_number)
+            continue
+        if scheduler is not None:
+            stopped_reason = scheduler.budget.stop_reason(needs_tokens=True)
+            if stopped_reason is not None:
+                remaining.append(panel_number)
+                continue
+
         print(f"Processing panel {panel_number}...")
 
         image_description = comic_generator.generate_comic_panel_image_description(
@@ -134,25 +231,44 @@ def step2_generate_image_descriptions(project_root: Path, panels_yaml_path: Opti
         )
 
         panel['generated_image_description'] = image_description
-        full_comic_data.append(panel)
+        completed.append(panel_number)
+        if scene_index is not None:
+            scene_index.add(panel_number, panel)
+            descriptions_by_panel[panel_number] = image_description
+        if scheduler is not None:
+            tokens = getattr(get_text_client(), "last_token_count", None)
+            if not tokens:
+                tokens = PROMPT_TEMPLATE_TOKENS + estimate_tokens(
+                    json.dumps(panel, ensure_ascii=False)
+                )
+            scheduler.budget.charge_tokens(tokens)
         print(f"Image description for panel {panel_number} generated.")
 
-    # 保存为 JSON
-    output_dir = project_root / 'output'
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_file_path = output_dir / 'generated_comic_data.json'
+    if scene_index is not None:
+        print(f"Reused image descriptions for {reused} near-duplicate panels.")
 
+    # 保存为 JSON（保持原顺序；预算不足未处理的 panel 没有 generated_image_description，step 3 会跳过）
     with output_file_path.open('w', encoding='utf-8') as f:
-        json.dump(full_comic_data, f, ensure_ascii=False, indent=2)
+        json.dump(comic_panels_data, f, ensure_ascii=False, indent=2)
 
     print(f"Complete comic data with image descriptions saved to {output_file_path}")
+    if scheduler is not None:
+        scheduler.write_report(project_root, 2, completed, remaining, stopped_reason)
     print("STEP 2 finished.")
 
-def step3_generate_comic_images(project_root: Path):
+def step3_generate_comic_images(
+    project_root: Path,
+    reuse_image_threshold: Optional[float] = None,
+    scheduler: Optional[PanelScheduler] = None,
+    resume: bool = False,
+):
     """
     第三步：
     - 读取 step2 生成的 comic_data.json
     - 遍历每个 panel，使用 generated_image_description 生成图片
+      （指定 reuse_image_threshold 时，近似重复的 panel 直接复用原 panel 的图片）
+    - 指定 scheduler 时按优先级顺序出图，图片数 / 时间预算用完就停下并写出报告
+    - resume=True 时沿用上次 final_comic_data_with_images.json 中已生成的图片
     - 保存图片到 output/comic_images 目录
     """
     print("=== STEP 3: 生成漫画图片 ===")
@@ -170,7 +286,125 @@ def step3_generate_comic_images(project_root: Path):
         comic_data: List[Dict[str, Any]] = json.load(f)
     print(f"Loaded {len(comic_data)} panels.")
 
-    comic_generator.generate_comic_images(project_root, comic_data)
+    final_data_path = project_root / 'output' / 'final_comic_data_with_images.json'
+    if resume and final_data_path.exists():
+        with final_data_path.open('r', encoding='utf-8') as f:
+            previous = {p.get('panel_number'): p for p in json.load(f) if p.get('generated_image_path')}
+        carried = 0
+        for i, panel in enumerate(comic_data):
+            prev = previous.get(panel.get('panel_number', i + 1))
+            if (
+                prev
+                and prev.get('generated_image_description') == panel.get('generated_image_description')
+                and (project_root / prev['generated_image_path']).exists()
+            ):
+                panel['generated_image_path'] = prev['generated_image_path']
+                carried += 1
+        print(f"Resuming: reused {carried} rendered images from {final_data_path}")
+
+    comic_generator.generate_comic_images(
+        project_root,
+        comic_data,
+        reuse_image_threshold=reuse_image_threshold,
+        scheduler=scheduler,
+        resume=resume,
+    )
+
+
+def step3_queue(
+    project_root: Path,
+    action: str,
+    queue_db: Optional[str] = None,
+    worker_id: Optional[str] = None,
+    lease_seconds: float = 300.0,
+    journal_mode: str = "wal",
+):
+    """
+    第三步（工作队列模式）：
+    - enqueue: 把 generated_comic_data.json 里的 panel 放进共享队列
+    - work:    领取并渲染 panel，可以在多个进程 / 机器上同时运行
+    - status:  查看队列进度
+    - export:  汇总结果为 final_comic_data_with_images.json
+    """
+    db_path = Path(queue_db) if queue_db else default_queue_path(project_root)
+    queue = PanelWorkQueue(db_path, lease_seconds=lease_seconds, journal_mode=journal_mode)
+
+    if action == "enqueue":
+        comic_data_path = project_root / 'output' / 'generated_comic_data.json'
+        if not comic_data_path.exists():
+            raise FileNotFoundError(
+                f"""找不到生成的漫画数据文件：{comic_data_path}
+请先运行 step 2 生成图片提示。"""
+            )
+        with comic_data_path.open('r', encoding='utf-8') as f:
+            comic_data: List[Dict[str, Any]] = json.load(f)
+        added, updated = queue.enqueue(comic_data)
+        print(f"Enqueued {added} new panels, updated {updated} changed/failed panels in {db_path}. "
+              f"Queue: {queue.counts()}")
+    elif action == "work":
+        run_worker(project_root, queue, worker_id)
+    elif action == "status":
+        print(f"Queue {db_path}: {queue.counts()}")
+        for panel_number, error in queue.failures():
+            print(f"  - panel {panel_number} failed: {error}")
+    elif action == "export":
+        export_results(project_root, queue)
+    else:
+        raise ValueError(f"Unknown queue action: {action}")
+
+def build_scheduler(
+    project_root: Path,
+    priority_weights: Optional[str] = None,
+    priority_characters: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    max_images: Optional[int] = None,
+    deadline_seconds: Optional[float] = None,
+    reference_images: Optional[Dict[str, str]] = None,
+) -> Optional[PanelScheduler]:
+    """
+    根据命令行参数构造 step 2 / 3 的调度器；一个调度相关参数都没给时返回 None（保持原来的顺序执行）。
+    重要角色默认取 data/reference_images.yaml 里配置了参考图的角色；
+    reference_images 为已加载好的 load_reference_images 结果，为 None 时现读。
+    """
+    if all(v is None for v in (priority_weights, priority_characters, max_tokens, max_images, deadline_seconds)):
+        return None
+
+    if priority_characters:
+        named = [c.strip() for c in priority_characters.replace("，", ",").split(",") if c.strip()]
+    else:
+        if reference_images is None:
+            reference_images = load_reference_images(project_root)
+        named = [
+            key.split(":", 1)[1]
+            for key in reference_images
+            if key.startswith("character:")
+        ]
+
+    return PanelScheduler(
+        weights=parse_priority_weights(priority_weights),
+        budget=RunBudget(max_tokens, max_images, deadline_seconds),
+        named_characters=named or None,
+    )
+
+
+def export_contact_sheet(project_root: Path, output_path: Optional[str] = None, columns: int = 6):
+    """
+    用缩略图金字塔中最小的一级，把已生成的 panel 拼成一张总览图，方便快速审阅。
+    """
+    image_paths = collect_panel_images(project_root)
+    if not image_paths:
+        raise FileNotFoundError("还没有生成任何 panel 图片，请先运行 step 3。")
+
+    sheet_path = Path(output_path) if output_path else project_root / 'output' / 'contact_sheet.jpg'
+    print(f"Building contact sheet for {len(image_paths)} panels...")
+    build_contact_sheet(
+        image_paths,
+        sheet_path,
+        default_cache_dir(project_root),
+        columns=columns,
+    )
+    print(f"Contact sheet saved to {sheet_path}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Novel to Comic two-step pipeline")
@@ -178,7 +412,7 @@ def main():
         "--step",
         type=int,
         choices=[1, 2, 3],
-        required=True,
+        default=None,
         help="选择执行哪一步：1 = 导出分镜草稿（YAML）；2 = 从分镜 YAML 生成图片提示；3 = 根据图片提示生成漫画图片"
     )
     parser.add_argument(
@@ -193,9 +427,168 @@ def main():
         default=None,
         help="step 2 指定分镜 YAML 路径（默认使用 output/comic_panels_draft.yaml）"
     )
+    parser.add_argument(
+        "--chapters",
+        type=str,
+        default=None,
+        help="只处理指定章节，例如 120-135 或 1-5,8（按「第X章」标题建立索引，默认处理全文）"
+    )
+
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=None,
+        help="step 2 近似重复场景检测阈值（0~1，例如 0.8）：场景文字+角色相似度达到该值的 panel 复用已有图片提示；默认不启用"
+    )
+    parser.add_argument(
+        "--reuse-image-threshold",
+        type=float,
+        default=None,
+        help="step 3 对相似度达到该值（0~1，例如 0.95）的近似重复 panel 直接复制原图；默认不启用（不复制时近似重复 panel 总是换 seed 重新生成）"
+    )
+    parser.add_argument(
+        "--priority-weights",
+        type=str,
+        default=None,
+        help="step 2/3 按优先级排序的权重，例如 priority=10,characters=3,dialogue=1（priority 为 panel 中显式写的 priority 字段）"
+    )
+    parser.add_argument(
+        "--priority-characters",
+        type=str,
+        default=None,
+        help="计入优先级的重要角色，逗号分隔（默认 reference_images.yaml 中有参考图的角色）"
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=None,
+        help="step 2 本次运行的 token 预算，用完后停止并写出报告"
+    )
+    parser.add_argument(
+        "--max-images",
+        type=int,
+        default=None,
+        help="step 3 本次运行最多调用多少次生图，用完后停止并写出报告"
+    )
+    parser.add_argument(
+        "--deadline-seconds",
+        type=float,
+        default=None,
+        help="step 2/3 本次运行的墙钟时间上限（秒），到时后处理完当前 panel 就停止"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="step 2/3 沿用上次运行已生成的描述 / 图片，只处理剩下的 panel"
+    )
+    parser.add_argument(
+        "--contact-sheet",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="PATH",
+        help="把已生成的 panel 缩略图拼成一张总览图（默认 output/contact_sheet.jpg），不执行任何 step"
+    )
+    parser.add_argument(
+        "--contact-sheet-columns",
+        type=int,
+        default=6,
+        help="总览图每行的 panel 数（默认 6）"
+    )
+    parser.add_argument(
+        "--record-cassette",
+        type=str,
+        default=None,
+        help="把本次所有文本/图片 API 请求和响应录制到该 cassette 文件（追加）"
+    )
+    parser.add_argument(
+        "--replay-cassette",
+        type=str,
+        default=None,
+        help="离线回放该 cassette 文件中的响应，不调用任何 API"
+    )
+    parser.add_argument(
+        "--cassette-match",
+        type=str,
+        choices=list(MATCH_MODES),
+        default="strict",
+        help="回放匹配方式：strict = 请求必须完全一致；lenient = 允许 prompt 空白差异并按录制顺序兜底"
+    )
+
+    parser.add_argument(
+        "--queue",
+        type=str,
+        choices=["enqueue", "work", "status", "export"],
+        default=None,
+        help="step 3 使用共享工作队列：enqueue = 入队；work = 作为 worker 领取并渲染；status = 查看进度；export = 汇总结果"
+    )
+    parser.add_argument(
+        "--queue-db",
+        type=str,
+        default=None,
+        help="工作队列 SQLite 文件路径（默认 output/step3_queue.sqlite）"
+    )
+    parser.add_argument(
+        "--worker-id",
+        type=str,
+        default=None,
+        help="worker 标识（默认 主机名:PID:随机后缀）"
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300.0,
+        help="worker 领取 panel 的租约时长，过期未续约的任务会被重新分配（默认 300 秒）"
+    )
+    parser.add_argument(
+        "--queue-journal-mode",
+        type=str,
+        choices=["wal", "delete"],
+        default="wal",
+        help="队列 SQLite 日志模式：同机多进程用 wal；多台机器共享存储时用 delete"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="以常驻服务方式运行：保持客户端热状态，通过本地 HTTP / Unix socket 提交任务"
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="--serve 监听地址（默认 127.0.0.1）"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="--serve 监听端口（默认 8765）"
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="--serve 改为监听该 Unix socket 路径（指定后忽略 --host/--port）"
+    )
+    parser.add_argument(
+        "--max-finished-jobs",
+        type=int,
+        default=200,
+        help="--serve 最多保留多少个已结束任务（连同日志），更早的自动清理（默认 200）"
+    )
 
     args = parser.parse_args()
 
+    if args.step is None and not args.serve and args.contact_sheet is None:
+        parser.error("必须指定 --step，或使用 --serve 启动常驻服务，或使用 --contact-sheet 生成总览图。")
+
+    if args.record_cassette and args.replay_cassette:
+        parser.error("--record-cassette 和 --replay-cassette 不能同时使用。")
+    if args.record_cassette:
+        activate_cassette(args.record_cassette, "record", args.cassette_match)
+    elif args.replay_cassette:
+        activate_cassette(args.replay_cassette, "replay", args.cassette_match)
+
     # 自动推断 project_root
     # cli.py 在 novel_comic_project/src/cli.py
     # parents[1] -> novel_comic_project
@@ -204,12 +597,39 @@ def main():
     else:
         project_root = Path(args.project_root).resolve()
 
-    if args.step == 1:
-        step1_export_comic_panels(project_root)
+    scheduler = None
+    if args.step in (2, 3) and not args.queue:
+        scheduler = build_scheduler(
+            project_root,
+            args.priority_weights,
+            args.priority_characters,
+            args.max_tokens,
+            args.max_images,
+            args.deadline_seconds,
+        )
+
+    if args.contact_sheet is not None:
+        export_contact_sheet(project_root, args.contact_sheet or None, args.contact_sheet_columns)
+    elif args.serve:
+        from .server import serve
+        serve(project_root, args.host, args.port, args.socket, args.max_finished_jobs)
+    elif args.step == 1:
+        step1_export_comic_panels(project_root, args.chapters)
     elif args.step == 2:
-        step2_generate_image_descriptions(project_root, args.panels_file)
+        step2_generate_image_descriptions(
+            project_root, args.panels_file, args.chapters, args.dedup_threshold, scheduler, args.resume
+        )
+    elif args.step == 3 and args.queue:
+        step3_queue(
+            project_root,
+            args.queue,
+            args.queue_db,
+            args.worker_id,
+            args.lease_seconds,
+            args.queue_journal_mode,
+        )
     elif args.step == 3:
-        step3_generate_comic_images(project_root)
+        step3_generate_comic_images(project_root, args.reuse_image_threshold, scheduler, args.resume)
     else:
         raise ValueError("Step must be 1, 2 or 3.")
 
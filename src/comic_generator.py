@@ -1,20 +1,29 @@
 from __future__ import annotations
 import os
 import json
+import shutil
 import yaml
 from pathlib import Path
 from typing import Dict, Any, List, Tuple
 
 from .api_client import get_text_client, get_image_client
+from .chapter_index import read_chapters
+from .panel_schema import PANEL_LIST_SCHEMA, find_missing_spans, salvage_panels
+from .scheduler import PanelScheduler
+from .thumbnails import build_thumbnail_pyramid, default_cache_dir
 
 
 # === 资源加载相关 ===
 
-def load_all_resources(project_root: str | Path) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+def load_all_resources(
+    project_root: str | Path,
+    chapters: str | None = None,
+) -> Tuple[str, Dict[str, str], Dict[str, str]]:
     """
     加载小说文本、角色图片、术语图片。
 
     project_root: 项目根目录（包含 data/、images/ 等）
+    chapters: 章节选择（例如 "120-135"），为 None 时读取全文
     返回:
         novel_text: 小说原文字符串
         character_images: {角色名: 图片路径}
@@ -26,7 +35,7 @@ def load_all_resources(project_root: str | Path) -> Tuple[str, Dict[str, str], D
     novel_path = root / "data" / "novel.txt"
     if not novel_path.exists():
         raise FileNotFoundError(f"找不到小说文件: {novel_path}")
-    novel_text = novel_path.read_text(encoding="utf-8")
+    novel_text = read_chapters(novel_path, chapters)
 
     # 角色图像
     characters_dir = root / "images" / "characters"
@@ -55,6 +64,7 @@ def parse_novel_to_comic_panels(
     novel_text: str,
     character_names: list[str] | None = None,
     term_names: list[str] | None = None,
+    max_repair_rounds: int = 3,
 ) -> list[dict[str, Any]]:
     """
     使用大模型把小说拆分成漫画分镜列表。
@@ -70,6 +80,10 @@ def parse_novel_to_comic_panels(
         ],
         # 这里只生成结构，不生成 image_prompt
     }
+
+    模型按 PANEL_LIST_SCHEMA 输出 JSON。个别 panel 格式错误或输出被截断时，
+    保留所有合法 panel，每轮把坏掉 / 缺失的序号区间和结尾续写合并成一次请求（最多 max_repair_rounds 轮），
+    不会因为一处格式问题丢掉整份结果。
     """
     character_names = character_names or []
     term_names = term_names or []
@@ -79,12 +93,12 @@ def parse_novel_to_comic_panels(
     prompt = f"""你是一名资深分镜师，请将以下小说内容拆解成漫画分镜。
 
 要求：
-- 输出一个 YAML list，每个元素代表一个 panel。
+- 输出一个 JSON 数组，每个元素代表一个 panel。
 - 每个 panel 必须包含字段：
   - panel_number: 序号，从 1 开始
   - scene_description: 对画面内容的简要说明
   - characters: 出现在这个分镜里的角色名字列表
-  - dialogue: 对话列表，每个元素是 {{character: 角色名, line: 台词}}
+  - dialogue: 对话列表，每个元素是 {{"character": 角色名, "line": 台词}}
 
 - 当前项目中已知角色：{character_names}
 - 已知术语/重要物件：{term_names}
@@ -93,18 +107,93 @@ def parse_novel_to_comic_panels(
 {novel_text}
 """
 
-    yaml_string = text_client.generate_text(prompt=prompt).strip()
-
-    # 防止模型包了一层 ```yaml ``` 代码块
-    if yaml_string.startswith("```yaml"):
-        yaml_string = yaml_string[len("```yaml"):].strip()
-    if yaml_string.endswith("```"):
-        yaml_string = yaml_string[:-3].strip()
-
-    panels = yaml.safe_load(yaml_string)
-    if not isinstance(panels, list):
-        raise ValueError("模型返回的分镜数据不是 list，请检查 prompt 或输出格式。")
-    return panels
+    raw = text_client.generate_text(prompt=prompt, response_schema=PANEL_LIST_SCHEMA)
+    panels, broken, truncated = salvage_panels(raw)
+
+    by_number: dict[int, dict[str, Any]] = {}
+    _merge_panels(by_number, panels)
+    if broken:
+        print(f"[WARN] 分镜输出中有 {len(broken)} 个 panel 格式错误: {sorted(set(broken))}")
+    if truncated:
+        print("[WARN] 分镜输出被截断，将从最后一个合法 panel 之后续写。")
+
+    for round_no in range(1, max_repair_rounds + 1):
+        spans = find_missing_spans(list(by_number.values()), broken)
+        if truncated:
+            # 最后一个合法 panel 之后的部分交给续写，不再单独补
+            last = max(by_number, default=0)
+            spans = [(lo, hi) for lo, hi in spans if lo <= last]
+        if not spans and not truncated:
+            break
+
+        tail_from = max(by_number, default=0) + 1 if truncated else None
+        print(f"Repair round {round_no}: re-requesting spans {spans}" + (f" + tail from {tail_from}" if truncated else ""))
+
+        def wanted(n: int) -> bool:
+            return any(lo <= n <= hi for lo, hi in spans) or (tail_from is not None and n >= tail_from)
+
+        # 所有缺失区间和结尾续写合并成一次请求，响应里只收请求过的序号
+        repaired, still_broken, repair_truncated = salvage_panels(text_client.generate_text(
+            prompt=_build_repair_prompt(prompt, by_number, spans, tail_from),
+            response_schema=PANEL_LIST_SCHEMA,
+        ))
+        _merge_panels(by_number, [p for p in repaired if wanted(p["panel_number"])])
+        broken = [n for n in still_broken if wanted(n)]
+        truncated = truncated and repair_truncated
+
+    if not by_number:
+        raise ValueError("模型返回的分镜数据中没有任何合法 panel，请检查 prompt 或输出格式。")
+
+    remaining = find_missing_spans(list(by_number.values()), broken)
+    if remaining or truncated:
+        print(f"[WARN] 修复后仍缺失分镜区间 {remaining}" + ("，且结尾可能不完整" if truncated else "") + "，请在 YAML 中手动补充。")
+
+    return [by_number[n] for n in sorted(by_number)]
+
+
+def _merge_panels(by_number: dict[int, dict[str, Any]], panels: list[dict[str, Any]]) -> None:
+    """按 panel_number 合并，已有的合法 panel 不会被覆盖。"""
+    for p in panels:
+        by_number.setdefault(p["panel_number"], p)
+
+
+def _build_repair_prompt(
+    base_prompt: str,
+    by_number: dict[int, dict[str, Any]],
+    spans: list[tuple[int, int]],
+    tail_from: int | None,
+) -> str:
+    """
+    构造一次性补齐所有缺失区间的 prompt：spans 里每个 [lo, hi] 只补这几个序号，
+    tail_from 不为 None 时再从该序号续写到小说结尾；每段都附上前后相邻 panel 作为衔接参考。
+    """
+    tasks = []
+    for lo, hi in spans:
+        tasks.append(f"- panel_number {lo} 到 {hi} 缺失或格式错误，请重新输出这 {hi - lo + 1} 个 panel。")
+    if tail_from is not None:
+        tasks.append(f"- 之前的输出在第 {tail_from - 1} 个 panel 之后中断了，请从 panel_number = {tail_from} 开始继续拆分到小说结尾。")
+
+    neighbours = sorted(
+        {lo - 1 for lo, _ in spans}
+        | {hi + 1 for _, hi in spans}
+        | ({tail_from - 1} if tail_from is not None else set())
+    )
+    context_lines = [
+        f"- panel {n}: {by_number[n]['scene_description']}"
+        for n in neighbours
+        if n in by_number
+    ]
+    context = "\n".join(context_lines) or "（无）"
+    task = "\n".join(tasks)
+
+    return f"""{base_prompt}
+
+---
+补充要求（只输出下面列出的序号，按序号从小到大放在同一个 JSON 数组里）：
+{task}
+相邻分镜（用于衔接，不要重复输出）：
+{context}
+"""
 from pathlib import Path
 import yaml
 from typing import Dict
@@ -175,21 +264,141 @@ def generate_comic_panel_image_description(
 
 # === STEP 3: 根据图片描述生成最终图片 ===
 
+def collect_reference_urls(panel: Dict[str, Any], reference_images: Dict[str, str]) -> list[str]:
+    """根据 panel 内容（角色 / scene_tag / style_tag）收集要传给图像模型的参考图 URL。"""
+    ref_urls: list[str] = []
+
+    # 人物参考
+    for ch in panel.get("characters", []):
+        key = f"character:{ch}"
+        url = reference_images.get(key)
+        if url:
+            ref_urls.append(url)
+
+    # 场景参考（如果你在 panel 里有 scene_tag 之类的字段）
+    scene_tag = panel.get("scene_tag")
+    if scene_tag:
+        key = f"scene:{scene_tag}"
+        url = reference_images.get(key)
+        if url:
+            ref_urls.append(url)
+
+    # 全局风格（比如每一话都用同一个 style tag）
+    style_tag = panel.get("style_tag", "水粉暖阳")  # 没写就用一个默认
+    key = f"style:{style_tag}"
+    url = reference_images.get(key)
+    if url:
+        ref_urls.append(url)
+
+    return ref_urls
+
+
+def render_panel_image(
+    image_client: Any,
+    project_root: Path,
+    output_dir: Path,
+    panel: Dict[str, Any],
+    panel_number: int,
+    reference_images: Dict[str, str],
+    **image_kwargs: Any,
+) -> str | None:
+    """
+    生成单个 panel 的图片，成功时返回相对 project_root 的图片路径，
+    图像客户端返回 None 时返回 None；API 错误直接抛出，由调用方决定如何处理。
+    image_kwargs 会透传给 image_client.generate_image（例如 seed）。
+    step 2 标记了 dedup_source_panel 的 panel 与原 panel 共用同一段描述，
+    没有显式指定 seed 时改用 panel 序号作 seed，避免生成一模一样的画面。
+    """
+    image_description = panel['generated_image_description']
+    ref_urls = collect_reference_urls(panel, reference_images)
+    if panel.get('dedup_source_panel') is not None:
+        image_kwargs.setdefault('seed', panel_number)
+
+    image_filename = f"panel_{panel_number:03d}.png"
+    output_path = output_dir / image_filename
+
+    print(f"Generating image for panel {panel_number} using description: {image_description[:60]}...")
+    image_path = image_client.generate_image(
+        prompt=image_description,
+        output_path=str(output_path),
+        size="2048x2048",
+        style="anime",
+        reference_images=ref_urls,  # ⭐ 关键：把参考图列表传进去
+        **image_kwargs,
+    )
+    if not image_path:
+        return None
+    _build_thumbnails(project_root, Path(image_path))
+    return str(Path(image_path).relative_to(project_root))
+
+
+def _build_thumbnails(project_root: Path, image_path: Path) -> None:
+    """panel 图落盘后立刻生成缩略图金字塔；失败只打警告，不影响出图。"""
+    try:
+        build_thumbnail_pyramid(image_path, default_cache_dir(project_root))
+    except Exception as e:
+        print(f"[WARN] Failed to build thumbnails for {image_path}: {e}")
+
+
+def reuse_panel_image(project_root: Path, output_dir: Path, source_image_path: str, panel_number: int) -> str:
+    """把近似重复的原 panel 图片复制为当前 panel 的图片，返回相对 project_root 的路径。"""
+    output_path = output_dir / f"panel_{panel_number:03d}.png"
+    shutil.copyfile(project_root / source_image_path, output_path)
+    _build_thumbnails(project_root, output_path)
+    return str(output_path.relative_to(project_root))
+
+
+def save_final_comic_data(project_root: Path, comic_data: List[Dict[str, Any]]) -> Path:
+    """把带 generated_image_path 的分镜数据写到 output/final_comic_data_with_images.json。"""
+    updated_comic_data_path = project_root / 'output' / 'final_comic_data_with_images.json'
+    with updated_comic_data_path.open('w', encoding='utf-8') as f:
+        json.dump(comic_data, f, ensure_ascii=False, indent=2)
+    return updated_comic_data_path
+
+
 def generate_comic_images(
     project_root: Path,
     comic_data: List[Dict[str, Any]],
     reference_images: Dict[str, str] | None = None,
-    image_output_dir_name: str = "comic_images"
+    image_output_dir_name: str = "comic_images",
+    reuse_image_threshold: float | None = None,
+    scheduler: PanelScheduler | None = None,
+    resume: bool = False,
 ) -> None:
+    """
+    逐个 panel 生成图片。
+
+    reuse_image_threshold: step 2 标记了 dedup_source_panel 的近似重复 panel，
+        相似度 >= 该值且原 panel 已有图片时直接复制原图。为 None 时不复制图片；
+        不复制的近似重复 panel 都会换一个 seed 重新生成，得到构图相近但略有变化的画面。
+    scheduler: 按优先级顺序出图，图片数 / 时间预算用完时停止，并写出
+        output/schedule_report_step3.json。
+    resume: 为 True 时跳过已带 generated_image_path（上次运行沿用）的 panel；
+        否则忽略输入里残留的图片路径，全部重新出图。
+    """
     print("=== STEP 3: 生成漫画图片 ===")
 
     reference_images = reference_images or {}
+    image_paths_by_panel: Dict[Any, str] = {}
 
     image_client = get_image_client()
     output_dir = project_root / 'output' / image_output_dir_name
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    for i, panel in enumerate(comic_data):
+    ordered = scheduler.order(comic_data) if scheduler is not None else list(enumerate(comic_data))
+    completed: List[Any] = []
+    remaining: List[Any] = []
+    failed: List[Any] = []
+    stopped_reason: str | None = None
+
+    # 已有图片的 panel 先登记，便于近似重复 panel 复用
+    for i, panel in ordered:
+        if not resume:
+            panel.pop('generated_image_path', None)
+        elif panel.get('generated_image_path'):
+            image_paths_by_panel[panel.get('panel_number', i + 1)] = panel['generated_image_path']
+
+    for i, panel in ordered:
         panel_number = panel.get('panel_number', i + 1)
         image_description = panel.get('generated_image_description')
 
@@ -197,54 +406,56 @@ def generate_comic_images(
             print(f"Skipping panel {panel_number}: No generated_image_description found.")
             continue
 
-        # 👇 这里根据 panel 内容收集参考图
-        ref_urls: list[str] = []
-
-        # 人物参考
-        for ch in panel.get("characters", []):
-            key = f"character:{ch}"
-            url = reference_images.get(key)
-            if url:
-                ref_urls.append(url)
-
-        # 场景参考（如果你在 panel 里有 scene_tag 之类的字段）
-        scene_tag = panel.get("scene_tag")
-        if scene_tag:
-            key = f"scene:{scene_tag}"
-            url = reference_images.get(key)
-            if url:
-                ref_urls.append(url)
-
-        # 全局风格（比如每一话都用同一个 style tag）
-        style_tag = panel.get("style_tag", "水粉暖阳")  # 没写就用一个默认
-        key = f"style:{style_tag}"
-        url = reference_images.get(key)
-        if url:
-            ref_urls.append(url)
+        if panel.get('generated_image_path'):
+            continue
+
+        source_number = panel.get('dedup_source_panel')
+        source_image = image_paths_by_panel.get(source_number)
+        if (
+            reuse_image_threshold is not None
+            and source_image
+            and panel.get('dedup_similarity', 0) >= reuse_image_threshold
+        ):
+            image_path = reuse_panel_image(project_root, output_dir, source_image, panel_number)
+            panel['generated_image_path'] = image_path
+            image_paths_by_panel[panel_number] = image_path
+            completed.append(panel_number)
+            print(f"Reused image of panel {source_number} for near-duplicate panel {panel_number}: {image_path}")
+            continue
 
-        image_filename = f"panel_{panel_number:03d}.png"
-        output_path = output_dir / image_filename
+        # 复用原图不花预算，所以预算用完后仍然走上面的分支；下面只拦真正的出图调用
+        if stopped_reason is not None:
+            remaining.append(panel_number)
+            continue
+
+        if scheduler is not None:
+            stopped_reason = scheduler.budget.stop_reason(needs_image=True)
+            if stopped_reason is not None:
+                remaining.append(panel_number)
+                continue
+            # 失败的调用同样消耗配额，所以按调用次数计
+            scheduler.budget.charge_image()
 
-        print(f"Generating image for panel {panel_number} using description: {image_description[:60]}...")
         try:
-            image_path = image_client.generate_image(
-                prompt=image_description,
-                output_path=str(output_path),
-                size="2048x2048",
-                style="anime",
-                reference_images=ref_urls  # ⭐ 关键：把参考图列表传进去
+            image_path = render_panel_image(
+                image_client, project_root, output_dir, panel, panel_number, reference_images
             )
             if image_path:
                 print(f"Successfully generated and saved image for panel {panel_number} to {image_path}")
-                panel['generated_image_path'] = str(Path(image_path).relative_to(project_root))
+                panel['generated_image_path'] = image_path
+                image_paths_by_panel[panel_number] = image_path
+                completed.append(panel_number)
             else:
                 print(f"Failed to generate image for panel {panel_number}. Image client returned None.")
+                failed.append(panel_number)
         except Exception as e:
             print(f"Error generating image for panel {panel_number}: {e}")
+            failed.append(panel_number)
 
-    updated_comic_data_path = project_root / 'output' / 'final_comic_data_with_images.json'
-    with updated_comic_data_path.open('w', encoding='utf-8') as f:
-        json.dump(comic_data, f, ensure_ascii=False, indent=2)
+    updated_comic_data_path = save_final_comic_data(project_root, comic_data)
 
     print(f"Updated comic data with image paths saved to {updated_comic_data_path}")
+    if scheduler is not None:
+        # 失败的 panel 同样算「未出图」，--resume 时会重试
+        scheduler.write_report(project_root, 3, completed, failed + remaining, stopped_reason)
     print("STEP 3 finished.")
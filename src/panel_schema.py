@@ -0,0 +1,251 @@
+from __future__ import annotations
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+import yaml
+
+# === STEP 1 分镜输出的 JSON Schema + 校验 / 部分修复 ===
+#
+# PANEL_LIST_SCHEMA 直接作为 Gemini 的 response_schema（OpenAPI 子集）传给 TextClient，
+# 让模型按结构化 JSON 输出。即使这样，长篇输出仍可能被截断或个别 panel 格式错误，
+# salvage_panels() 会按括号深度逐个 panel 解析（不依赖字段顺序），保留所有合法的 panel，并报告坏掉 / 缺失的序号，
+# 由 comic_generator 只针对这些区间重新请求。
+
+DIALOGUE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "character": {"type": "string"},
+        "line": {"type": "string"},
+    },
+    "required": ["character", "line"],
+}
+
+PANEL_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "panel_number": {"type": "integer"},
+        "scene_description": {"type": "string"},
+        "characters": {"type": "array", "items": {"type": "string"}},
+        "dialogue": {"type": "array", "items": DIALOGUE_SCHEMA},
+    },
+    "required": ["panel_number", "scene_description", "characters", "dialogue"],
+}
+
+PANEL_LIST_SCHEMA: Dict[str, Any] = {
+    "type": "array",
+    "items": PANEL_SCHEMA,
+}
+
+_PANEL_NUMBER_RE = re.compile(r'"panel_number"\s*:\s*(\d+)')
+# 顶层数组里下一个元素的起点（或数组结尾）
+_NEXT_ITEM_RE = re.compile(r"[{\]]")
+# 一个数组元素结束后只能跟逗号、数组结尾或文本结尾
+_ITEM_END_RE = re.compile(r"\s*(?:[,\]]|$)")
+
+
+def strip_code_fence(text: str) -> str:
+    """去掉模型可能包上的 ```json / ```yaml 代码块。"""
+    text = text.strip()
+    if text.startswith("```"):
+        first_newline = text.find("\n")
+        text = text[first_newline + 1:] if first_newline != -1 else ""
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
+def validate_panel(panel: Any) -> List[str]:
+    """
+    检查单个 panel 是否符合 PANEL_SCHEMA，返回错误列表（空 list 表示合法）。
+    characters / dialogue 为 null 时视为空列表，会就地改成 []。
+    """
+    if not isinstance(panel, dict):
+        return [f"panel 不是 dict: {type(panel).__name__}"]
+
+    errors: List[str] = []
+
+    number = panel.get("panel_number")
+    if not isinstance(number, int) or isinstance(number, bool) or number < 1:
+        errors.append(f"panel_number 无效: {number!r}")
+
+    scene = panel.get("scene_description")
+    if not isinstance(scene, str) or not scene.strip():
+        errors.append("scene_description 缺失或为空")
+
+    for key in ("characters", "dialogue"):
+        if panel.get(key) is None:
+            panel[key] = []
+
+    characters = panel["characters"]
+    if not isinstance(characters, list) or not all(isinstance(c, str) for c in characters):
+        errors.append("characters 应为字符串列表")
+
+    dialogue = panel["dialogue"]
+    if not isinstance(dialogue, list):
+        errors.append("dialogue 应为列表")
+    else:
+        for j, d in enumerate(dialogue):
+            if (
+                not isinstance(d, dict)
+                or not isinstance(d.get("character"), str)
+                or not isinstance(d.get("line"), str)
+            ):
+                errors.append(f"dialogue[{j}] 应为 {{character, line}}")
+
+    return errors
+
+
+def salvage_panels(raw: str) -> Tuple[List[Dict[str, Any]], List[int], bool]:
+    """
+    从模型输出中尽量多地取出合法 panel。
+
+    返回:
+        panels: 通过校验的 panel（按出现顺序）
+        broken_numbers: 能认出序号、但解析或校验失败的 panel_number
+        truncated: 输出是否在最后一个 panel 中途被截断（需要续写）
+    """
+    text = strip_code_fence(raw)
+
+    # 快速路径：整体就是合法 JSON
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        data = [data]
+    if isinstance(data, list):
+        return _split_valid(data)
+
+    # 逐个 panel 解析：按括号深度找顶层数组里的每个对象，不依赖字段顺序
+    # （带 response_schema 时 Gemini 默认按字母序输出字段，panel_number 不在第一个）
+    decoder = json.JSONDecoder()
+    panels: List[Dict[str, Any]] = []
+    broken: List[int] = []
+    truncated = False
+
+    bracket, brace = text.find("["), text.find("{")
+    in_array = bracket != -1 and (brace == -1 or bracket < brace)
+    pos = bracket + 1 if in_array else max(brace, 0)
+    closed = False
+
+    while True:
+        m = _NEXT_ITEM_RE.search(text, pos)
+        if m is None:
+            break
+        if m.group() == "]":
+            closed = True
+            break
+        start = m.start()
+        end = _object_end(text, start)
+        try:
+            obj, pos = decoder.raw_decode(text, start)
+        except ValueError:
+            # 括号配对的结尾后面紧跟逗号 / ] 时才可信；否则（例如坏 panel 里有未闭合的字符串）
+            # 往后找下一个能完整解析、带 panel_number 的对象重新对齐
+            if end is not None and _ITEM_END_RE.match(text, end):
+                next_pos = end
+            else:
+                next_pos = _next_panel_start(decoder, text, start + 1)
+            number = _PANEL_NUMBER_RE.search(text, start, len(text) if next_pos is None else next_pos)
+            if number:
+                broken.append(int(number.group(1)))
+            if next_pos is None:
+                truncated = end is None
+                closed = True
+                break
+            pos = next_pos
+            continue
+        if validate_panel(obj):
+            if isinstance(obj, dict) and isinstance(obj.get("panel_number"), int):
+                broken.append(obj["panel_number"])
+        else:
+            panels.append(obj)
+        if not in_array:
+            break
+
+    if not panels and not broken:
+        # 模型完全没按 JSON 输出时，兼容旧的 YAML 格式
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError:
+            data = None
+        if isinstance(data, list):
+            return _split_valid(data)
+        return [], [], True
+
+    # 最后一个 panel 完整但数组没有闭合，同样视为被截断
+    if in_array and not closed:
+        truncated = True
+
+    return panels, broken, truncated
+
+
+def _next_panel_start(decoder: json.JSONDecoder, text: str, pos: int) -> int | None:
+    """从 pos 开始找下一个能完整解析、且带 panel_number 的对象的起点。"""
+    while True:
+        start = text.find("{", pos)
+        if start == -1:
+            return None
+        try:
+            obj, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict) and "panel_number" in obj:
+            return start
+        pos = start + 1
+
+
+def _object_end(text: str, start: int) -> int | None:
+    """返回从 start 处的 { 开始、与之配对的 } 之后的位置；到文本末尾都没闭合时返回 None。"""
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def _split_valid(items: List[Any]) -> Tuple[List[Dict[str, Any]], List[int], bool]:
+    panels: List[Dict[str, Any]] = []
+    broken: List[int] = []
+    for item in items:
+        if validate_panel(item):
+            if isinstance(item, dict) and isinstance(item.get("panel_number"), int):
+                broken.append(item["panel_number"])
+        else:
+            panels.append(item)
+    return panels, broken, False
+
+
+def find_missing_spans(panels: List[Dict[str, Any]], broken_numbers: List[int]) -> List[Tuple[int, int]]:
+    """
+    根据已有的合法 panel 和坏掉的序号，算出需要重新请求的闭区间列表，
+    例如已有 1,2,5 且 6 坏掉 -> [(3, 4), (6, 6)]。
+    """
+    have = {p["panel_number"] for p in panels}
+    upper = max(list(have) + list(broken_numbers) + [0])
+    missing = sorted(n for n in range(1, upper + 1) if n not in have)
+
+    spans: List[Tuple[int, int]] = []
+    for n in missing:
+        if spans and spans[-1][1] == n - 1:
+            spans[-1] = (spans[-1][0], n)
+        else:
+            spans.append((n, n))
+    return spans
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import hashlib
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+# === 近似重复场景检测（MinHash + LSH） ===
+#
+# 连载小说里经常出现几乎一样的分镜（同一个港口远景、同一个房间……）。
+# 这里把 scene_description 的字符 n-gram 做成 shingle 集合，
+# 用 MinHash 签名 + LSH 分桶快速找候选，再用精确 Jaccard 相似度确认。
+# 出场角色是硬条件：角色集合不同的 panel 即使场景文字几乎一样也不算重复，
+# 否则会复用写着别人名字的 prompt / 别人的图片。
+#
+# step 2 用它复用已有的 image prompt（省掉 LLM 调用），
+# step 3 对相似度足够高的 panel 直接复用已渲染的图片（省掉生图调用）。
+
+# 自动选择 LSH 分段时，相似度恰好等于 threshold 的 panel 进入候选的最低概率
+LSH_TARGET_RECALL = 0.99
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# 去掉空白和常见中英文标点，避免只因标点不同而相似度下降
+_NOISE_RE = re.compile(r"[\s，。、；：！？“”‘’（）《》…—,.;:!?\"'()\[\]-]+")
+
+
+def _hash64(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def panel_shingles(panel: Dict[str, Any], ngram: int = 3) -> Set[str]:
+    """scene_description 去掉空白和标点后的字符 n-gram。"""
+    text = _NOISE_RE.sub("", panel.get("scene_description") or "")
+    shingles: Set[str] = set()
+    if len(text) <= ngram:
+        if text:
+            shingles.add(text)
+    else:
+        for i in range(len(text) - ngram + 1):
+            shingles.add(text[i:i + ngram])
+    return shingles
+
+
+def panel_cast(panel: Dict[str, Any]) -> FrozenSet[str]:
+    """出场角色集合（忽略顺序和重复）。"""
+    return frozenset(c.strip() for c in panel.get("characters") or [] if c and c.strip())
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_recall(similarity: float, bands: int, rows: int) -> float:
+    """Jaccard 相似度为 similarity 的一对 panel 至少在一个 band 里撞桶的概率：1 - (1 - s^r)^b。"""
+    return 1.0 - (1.0 - similarity ** rows) ** bands
+
+
+def choose_bands(threshold: float, num_perm: int, target_recall: float = LSH_TARGET_RECALL) -> int:
+    """
+    在 num_perm 的约数里选 band 数：保证相似度为 threshold 时的候选概率 >= target_recall，
+    同时每段行数尽量多（行数越多，低相似度的误候选越少）。
+    """
+    for rows in range(num_perm, 0, -1):
+        if num_perm % rows == 0 and lsh_recall(threshold, num_perm // rows, rows) >= target_recall:
+            return num_perm // rows
+    return num_perm
+
+
+class SceneIndex:
+    """
+    panel 相似度索引。
+
+    threshold: 场景文字的精确 Jaccard 相似度达到该值、且角色集合完全相同才算近似重复（0~1）
+    num_perm / bands: MinHash 签名长度和 LSH 分段数。bands 为 None 时按 threshold 自动选择
+                      （见 choose_bands），例如 64 个哈希下 0.8 -> 16 段 x 4 行（候选概率约 99.98%），
+                      0.5 -> 32 段 x 2 行（约 99.99%）；固定 16 x 4 在 0.5 时只有约 64%。
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: Optional[int] = None, ngram: int = 3):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+        if bands is None:
+            bands = choose_bands(threshold, num_perm)
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands.")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+
+        # 固定种子生成哈希参数，保证同样的输入每次得到同样的签名
+        self._perms: List[Tuple[int, int]] = []
+        for i in range(num_perm):
+            a = _hash64(f"minhash-a-{i}") % (_MERSENNE_PRIME - 1) + 1
+            b = _hash64(f"minhash-b-{i}") % _MERSENNE_PRIME
+            self._perms.append((a, b))
+
+        self._buckets: List[Dict[Tuple[int, ...], List[Any]]] = [{} for _ in range(bands)]
+        self._shingles: Dict[Any, Set[str]] = {}
+        self._casts: Dict[Any, FrozenSet[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._shingles)
+
+    def signature(self, shingles: Set[str]) -> List[int]:
+        if not shingles:
+            return [_MAX_HASH] * self.num_perm
+        hashes = [_hash64(s) for s in shingles]
+        return [
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._perms
+        ]
+
+    def _band_keys(self, signature: List[int]) -> List[Tuple[int, ...]]:
+        return [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def add(self, key: Any, panel: Dict[str, Any]) -> None:
+        shingles = panel_shingles(panel, self.ngram)
+        self._shingles[key] = shingles
+        self._casts[key] = panel_cast(panel)
+        for band, band_key in zip(self._buckets, self._band_keys(self.signature(shingles))):
+            band.setdefault(band_key, []).append(key)
+
+    def query(self, panel: Dict[str, Any]) -> Optional[Tuple[Any, float]]:
+        """返回 (最相似的 key, Jaccard 相似度)；没有角色相同且达到 threshold 的候选时返回 None。"""
+        shingles = panel_shingles(panel, self.ngram)
+        if not shingles:
+            return None
+        cast = panel_cast(panel)
+
+        candidates: Set[Any] = set()
+        for band, band_key in zip(self._buckets, self._band_keys(self.signature(shingles))):
+            candidates.update(band.get(band_key, ()))
+
+        best: Optional[Tuple[Any, float]] = None
+        for key in candidates:
+            if self._casts[key] != cast:
+                continue
+            similarity = jaccard(shingles, self._shingles[key])
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
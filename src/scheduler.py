@@ -0,0 +1,161 @@
+from __future__ import annotations
+import json
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# === 预算 / 优先级感知的 panel 调度（step 2 / step 3） ===
+#
+# - 按优先级排序：显式 priority 字段、出现的重要角色数、台词数，各自乘以可配置的权重
+# - 预算：每次运行的 token 上限（step 2）、图片张数上限（step 3）、墙钟时间上限
+# - 预算用完时干净地停下，写出 output/schedule_report_step{N}.json，
+#   记录已完成 / 未完成的 panel；加 --resume 再跑一次即可从剩下的继续。
+
+DEFAULT_PRIORITY_WEIGHTS: Dict[str, float] = {
+    "priority": 10.0,    # panel 里显式写的 priority 字段
+    "characters": 3.0,   # 出现的重要角色数
+    "dialogue": 1.0,     # 台词条数
+}
+
+# 提示词模板本身的大致 token 数（TextClient 拿不到 usage 时用于估算）
+PROMPT_TEMPLATE_TOKENS = 400
+
+_CJK_RE = re.compile(r"[⺀-鿿가-힯＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token / 字，其余约 4 字符 / token。"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def parse_priority_weights(spec: Optional[str]) -> Dict[str, float]:
+    """解析 "priority=10,characters=3,dialogue=1"，没写的项用默认权重。"""
+    weights = dict(DEFAULT_PRIORITY_WEIGHTS)
+    if not spec:
+        return weights
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, value = part.partition("=")
+        name = name.strip()
+        if not sep or name not in DEFAULT_PRIORITY_WEIGHTS:
+            raise ValueError(
+                f"无效的优先级权重: {part!r}（可用项: {', '.join(DEFAULT_PRIORITY_WEIGHTS)}）"
+            )
+        weights[name] = float(value)
+    return weights
+
+
+class RunBudget:
+    """单次运行的 token / 图片 / 时间预算，None 表示不限制。"""
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_images: Optional[int] = None,
+        deadline_seconds: Optional[float] = None,
+    ):
+        self.max_tokens = max_tokens
+        self.max_images = max_images
+        self.deadline_seconds = deadline_seconds
+        self.started_at = time.monotonic()
+        self.tokens_used = 0
+        self.images_used = 0
+
+    def charge_tokens(self, tokens: int) -> None:
+        self.tokens_used += tokens
+
+    def charge_image(self) -> None:
+        self.images_used += 1
+
+    def stop_reason(self, needs_tokens: bool = False, needs_image: bool = False) -> Optional[str]:
+        """预算不够再处理下一个 panel 时返回原因，否则返回 None。"""
+        if self.deadline_seconds is not None and time.monotonic() - self.started_at >= self.deadline_seconds:
+            return f"deadline of {self.deadline_seconds:g}s reached"
+        if needs_tokens and self.max_tokens is not None and self.tokens_used >= self.max_tokens:
+            return f"token budget of {self.max_tokens} exhausted ({self.tokens_used} used)"
+        if needs_image and self.max_images is not None and self.images_used >= self.max_images:
+            return f"image budget of {self.max_images} exhausted"
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_tokens": self.max_tokens,
+            "tokens_used": self.tokens_used,
+            "max_images": self.max_images,
+            "images_used": self.images_used,
+            "deadline_seconds": self.deadline_seconds,
+            "elapsed_seconds": round(time.monotonic() - self.started_at, 2),
+        }
+
+
+class PanelScheduler:
+    """
+    决定 panel 的处理顺序，并跟踪预算。
+
+    named_characters: 视为「重要角色」的名字集合；为 None 时 panel 里出现的所有角色都算
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        budget: Optional[RunBudget] = None,
+        named_characters: Optional[Iterable[str]] = None,
+    ):
+        self.weights = weights or dict(DEFAULT_PRIORITY_WEIGHTS)
+        self.budget = budget or RunBudget()
+        self.named_characters: Optional[Set[str]] = set(named_characters) if named_characters is not None else None
+
+    def score(self, panel: Dict[str, Any]) -> float:
+        characters = panel.get("characters") or []
+        if self.named_characters is not None:
+            characters = [c for c in characters if c in self.named_characters]
+        try:
+            explicit = float(panel.get("priority") or 0)
+        except (TypeError, ValueError):
+            explicit = 0.0
+        return (
+            self.weights["priority"] * explicit
+            + self.weights["characters"] * len(characters)
+            + self.weights["dialogue"] * len(panel.get("dialogue") or [])
+        )
+
+    def order(self, panels: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any]]]:
+        """返回按优先级从高到低排好的 (原下标, panel)；同分时保持原顺序。"""
+        indexed = list(enumerate(panels))
+        indexed.sort(key=lambda item: (-self.score(item[1]), item[0]))
+        return indexed
+
+    def write_report(
+        self,
+        project_root: Path,
+        step: int,
+        completed: List[Any],
+        remaining: List[Any],
+        stopped_reason: Optional[str],
+    ) -> Path:
+        """写出 output/schedule_report_step{N}.json，并打印摘要。"""
+        report = {
+            "step": step,
+            "stopped_reason": stopped_reason,
+            "budget": self.budget.to_dict(),
+            "weights": self.weights,
+            "completed": completed,
+            "remaining": remaining,
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        path = project_root / "output" / f"schedule_report_step{step}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        if stopped_reason:
+            print(f"[WARN] STEP {step} stopped early: {stopped_reason}. "
+                  f"{len(remaining)} panels left: {remaining}")
+            print(f"Re-run with --resume to continue. Report saved to {path}")
+        else:
+            print(f"Schedule report saved to {path}")
+        return path
@@ -0,0 +1,508 @@
+from __future__ import annotations
+import itertools
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from . import comic_generator
+from .api_client import get_image_client, get_text_client
+from .chapter_index import parse_chapter_selection
+from .cli import (
+    build_scheduler,
+    load_reference_images,
+    step1_export_comic_panels,
+    step2_generate_image_descriptions,
+    step3_generate_comic_images,
+)
+from .scheduler import parse_priority_weights
+
+# === 常驻本地任务服务（daemon 模式） ===
+#
+# python -m src.cli --serve [--port 8765 | --socket /tmp/novel_comic.sock]
+#
+# 进程常驻，TextClient / ImageClient 单例、httpx 连接池、已导入的 SDK
+# 在多次任务之间保持热状态；任务进入带优先级的内部队列，由单个 worker 线程依次执行
+# （各 step 会写同一批 output 文件，所以不并发执行）。
+# reference_images.yaml 和 step 2 用到的资源（小说章节、角色 / 术语图列表）也缓存在进程里，
+# 按源文件 mtime 判断是否需要重新加载。
+#
+# HTTP API（JSON）：
+#   POST /jobs                   {"step": 1|2|3, "priority": 0, "chapters": "120-135", "panels_file": "...",
+#                                 "dedup_threshold": 0.8, "reuse_image_threshold": 0.95,
+#                                 "max_tokens": 20000, "max_images": 10, "deadline_seconds": 600, "resume": true, ...}
+#   GET  /jobs                   所有任务概要
+#   GET  /jobs/<id>              单个任务状态
+#   GET  /jobs/<id>/events?since=N
+#                                按行流式输出任务日志（NDJSON），任务结束后关闭连接
+#   POST /jobs/<id>/cancel       取消还在排队的任务
+#   GET  /health
+#
+# 参数类型不对（例如 "max_tokens": "abc"、"resume": "maybe"）时 POST /jobs 直接返回 400。
+# 已结束的任务（连同日志）只保留最近 max_finished_jobs 个。
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+# 参数名 -> 类型
+JOB_PARAMS: Dict[str, type] = {
+    "chapters": str,
+    "panels_file": str,
+    "dedup_threshold": float,
+    "reuse_image_threshold": float,
+    "priority_weights": str,
+    "priority_characters": str,
+    "max_tokens": int,
+    "max_images": int,
+    "deadline_seconds": float,
+    "resume": bool,
+}
+DEFAULT_MAX_FINISHED_JOBS = 200
+
+_TRUE_STRINGS = ("true", "1", "yes")
+_FALSE_STRINGS = ("false", "0", "no")
+
+
+def _convert_param(name: str, value: Any) -> Any:
+    """把 JSON 里的任务参数转成 JOB_PARAMS 声明的类型，并做基本的取值检查；不合法时抛 ValueError。"""
+    kind = JOB_PARAMS[name]
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in _TRUE_STRINGS + _FALSE_STRINGS:
+            return value.strip().lower() in _TRUE_STRINGS
+        raise ValueError(f"{name} must be a boolean, got {value!r}")
+
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{name} must be {kind.__name__}, got {value!r}")
+
+    if kind is str:
+        if isinstance(value, float):
+            raise ValueError(f"{name} must be a string, got {value!r}")
+        value = str(value)
+        if name == "chapters":
+            parse_chapter_selection(value)
+        elif name == "priority_weights":
+            parse_priority_weights(value)
+        return value
+
+    try:
+        converted = kind(value)
+    except ValueError:
+        raise ValueError(f"{name} must be {kind.__name__}, got {value!r}") from None
+    if kind is int and isinstance(value, float) and converted != value:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    if name in ("dedup_threshold", "reuse_image_threshold") and not 0 < converted <= 1:
+        raise ValueError(f"{name} must be in (0, 1], got {value!r}")
+    if converted < 0:
+        raise ValueError(f"{name} must not be negative, got {value!r}")
+    return converted
+
+
+def parse_job_params(data: Dict[str, Any]) -> Dict[str, Any]:
+    """从 POST /jobs 的请求体里取出已知参数并转换类型，null 视为没给。"""
+    return {name: _convert_param(name, data[name]) for name in JOB_PARAMS if data.get(name) is not None}
+
+
+class Job:
+    def __init__(self, job_id: str, step: int, priority: int, params: Dict[str, Any]):
+        self.id = job_id
+        self.step = step
+        self.priority = priority
+        self.params = params
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.log: List[str] = []
+        self.changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def append_log(self, line: str) -> None:
+        with self.changed:
+            self.log.append(line)
+            self.changed.notify_all()
+
+    def set_status(self, status: str, error: Optional[str] = None) -> None:
+        with self.changed:
+            self.status = status
+            self.error = error
+            if status == "running":
+                self.started_at = time.time()
+            elif status in ("succeeded", "failed", "cancelled"):
+                self.finished_at = time.time()
+            self.changed.notify_all()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "step": self.step,
+            "priority": self.priority,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "log_lines": len(self.log),
+        }
+
+
+class _JobOutput:
+    """
+    替换 sys.stdout：worker 线程里 print 的内容按行追加到当前任务日志，
+    同时照常写到原来的 stdout。
+    """
+
+    def __init__(self, original, server: "JobServer"):
+        self.original = original
+        self.server = server
+        self._buffers: Dict[int, str] = {}
+
+    def write(self, s: str) -> int:
+        self.original.write(s)
+        job = self.server.current_job
+        if job is not None and threading.current_thread() is self.server.worker:
+            buf = self._buffers.get(id(job), "") + s
+            *lines, rest = buf.split("\n")
+            for line in lines:
+                job.append_log(line)
+            self._buffers[id(job)] = rest
+        return len(s)
+
+    def flush_job(self, job: Job) -> None:
+        rest = self._buffers.pop(id(job), "")
+        if rest:
+            job.append_log(rest)
+
+    def flush(self) -> None:
+        self.original.flush()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.original, name)
+
+
+class JobServer:
+    def __init__(self, project_root: Path, max_finished_jobs: int = DEFAULT_MAX_FINISHED_JOBS):
+        self.project_root = project_root
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs: Dict[str, Job] = {}
+        self.queue: "queue.PriorityQueue[tuple[int, int, str]]" = queue.PriorityQueue()
+        self.current_job: Optional[Job] = None
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run_worker, name="job-worker", daemon=True)
+        self.output = _JobOutput(sys.stdout, self)
+        # name -> (key, value)；只在 worker 线程里读写
+        self._cache: Dict[str, Tuple[Any, Any]] = {}
+
+    def warm_up(self) -> None:
+        """启动时提前创建客户端单例（导入 SDK、建立连接池），缺配置时只打警告。"""
+        for name, factory in (("text", get_text_client), ("image", get_image_client)):
+            try:
+                factory()
+                print(f"[INFO] Warmed up {name} client.")
+            except Exception as e:
+                print(f"[WARN] Could not warm up {name} client: {e}")
+
+    def start(self) -> None:
+        sys.stdout = self.output
+        self.worker.start()
+
+    # --- 资源缓存 ---
+
+    def _cached(self, name: str, key: Any, loader: Callable[[], Any]) -> Any:
+        entry = self._cache.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        value = loader()
+        self._cache[name] = (key, value)
+        return value
+
+    def _mtime_key(self, *relative_paths: str) -> Tuple[Optional[int], ...]:
+        """各路径的 mtime_ns（目录增删文件时 mtime 也会变），不存在时为 None。"""
+        key = []
+        for rel in relative_paths:
+            try:
+                key.append((self.project_root / rel).stat().st_mtime_ns)
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def reference_images(self) -> Dict[str, str]:
+        return self._cached(
+            "reference_images",
+            self._mtime_key("data/reference_images.yaml"),
+            lambda: load_reference_images(self.project_root),
+        )
+
+    def resources(self, chapters: Optional[str]) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+        return self._cached(
+            "resources",
+            (chapters, self._mtime_key("data/novel.txt", "images/characters", "images/terms")),
+            lambda: comic_generator.load_all_resources(self.project_root, chapters),
+        )
+
+    # --- job management ---
+
+    def submit(self, step: int, priority: int = 0, params: Optional[Dict[str, Any]] = None) -> Job:
+        if step not in (1, 2, 3):
+            raise ValueError("step must be 1, 2 or 3.")
+        seq = next(self._seq)
+        job = Job(f"job-{seq}", step, priority, params or {})
+        with self._lock:
+            self.jobs[job.id] = job
+        # 优先级数值越大越先执行，同优先级按提交顺序
+        self.queue.put((-priority, seq, job.id))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def snapshot(self) -> List[Job]:
+        """返回当前所有任务的列表副本；HTTP 线程遍历时 submit 可能同时在写 jobs。"""
+        with self._lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        with job.changed:
+            if job.status != "queued":
+                return False
+            job.set_status("cancelled")
+        self._prune_finished()
+        return True
+
+    def _prune_finished(self) -> None:
+        """只保留最近结束的 max_finished_jobs 个任务；正在推送日志的连接仍持有 Job 引用，不受影响。"""
+        with self._lock:
+            finished = sorted((j for j in self.jobs.values() if j.done), key=lambda j: j.finished_at or 0)
+            for job in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+                del self.jobs[job.id]
+
+    def _run_worker(self) -> None:
+        while True:
+            _, _, job_id = self.queue.get()
+            job = self.get(job_id)
+            if job is None:
+                continue
+            with job.changed:
+                if job.status != "queued":
+                    continue
+                job.set_status("running")
+
+            self.current_job = job
+            try:
+                self._run_step(job)
+            except BaseException as e:
+                traceback.print_exc(file=self.output)
+                self.output.flush_job(job)
+                job.set_status("failed", f"{type(e).__name__}: {e}")
+            else:
+                self.output.flush_job(job)
+                job.set_status("succeeded")
+            finally:
+                self.current_job = None
+                self._prune_finished()
+
+    def _run_step(self, job: Job) -> None:
+        params = job.params
+        scheduler = None
+        if job.step in (2, 3):
+            scheduler = build_scheduler(
+                self.project_root,
+                params.get("priority_weights"),
+                params.get("priority_characters"),
+                params.get("max_tokens"),
+                params.get("max_images"),
+                params.get("deadline_seconds"),
+                reference_images=self.reference_images(),
+            )
+
+        if job.step == 1:
+            step1_export_comic_panels(self.project_root, params.get("chapters"))
+        elif job.step == 2:
+            step2_generate_image_descriptions(
+                self.project_root,
+                params.get("panels_file"),
+                params.get("chapters"),
+                params.get("dedup_threshold"),
+                scheduler,
+                params.get("resume", False),
+                resources=self.resources(params.get("chapters")),
+            )
+        elif job.step == 3:
+            step3_generate_comic_images(
+                self.project_root,
+                params.get("reuse_image_threshold"),
+                scheduler,
+                params.get("resume", False),
+            )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "NovelComicJobServer/0.1"
+
+    @property
+    def jobs(self) -> JobServer:
+        return self.server.job_server
+
+    def log_message(self, format: str, *args) -> None:
+        # Unix socket 下 client_address 是空字符串，不能用默认实现
+        sys.stderr.write(f"[HTTP] {format % args}\n")
+
+    def _send_json(self, status: int, payload: Any) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        data = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(data, dict):
+            raise ValueError("request body must be a JSON object.")
+        return data
+
+    def _job_or_404(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": f"unknown job: {job_id}"})
+        return job
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+
+        if parts == ["health"]:
+            self._send_json(200, {"status": "ok", "queued": self.jobs.queue.qsize()})
+        elif parts == ["jobs"]:
+            self._send_json(200, [job.to_dict() for job in self.jobs.snapshot()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._job_or_404(parts[1])
+            if job:
+                self._send_json(200, job.to_dict())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self._job_or_404(parts[1])
+            if job:
+                since_raw = parse_qs(url.query).get("since", ["0"])[0]
+                try:
+                    since = int(since_raw)
+                except ValueError:
+                    self._send_json(400, {"error": f"since must be an integer, got {since_raw!r}"})
+                    return
+                self._stream_events(job, since)
+        else:
+            self._send_json(404, {"error": f"not found: {url.path}"})
+
+    def do_POST(self) -> None:
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        try:
+            if parts == ["jobs"]:
+                data = self._read_json()
+                params = parse_job_params(data)
+                job = self.jobs.submit(int(data.get("step", 0)), int(data.get("priority", 0)), params)
+                self._send_json(202, job.to_dict())
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+                job = self._job_or_404(parts[1])
+                if job:
+                    cancelled = self.jobs.cancel(job.id)
+                    self._send_json(200 if cancelled else 409, job.to_dict())
+            else:
+                self._send_json(404, {"error": f"not found: {self.path}"})
+        except KeyError as e:
+            # 任务在 404 检查之后刚好被清理掉
+            self._send_json(404, {"error": f"unknown job: {e.args[0]}"})
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+
+    def _stream_events(self, job: Job, since: int) -> None:
+        """逐行推送任务日志（NDJSON），任务结束时推送最终状态并关闭连接。"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        index = max(since, 0)
+        try:
+            while True:
+                with job.changed:
+                    while index >= len(job.log) and not job.done:
+                        job.changed.wait(timeout=15)
+                        if index >= len(job.log) and not job.done:
+                            break  # 超时：发一次心跳
+                    lines = job.log[index:]
+                    finished = job.done
+
+                if lines:
+                    for line in lines:
+                        self._write_event({"type": "log", "index": index, "line": line})
+                        index += 1
+                elif not finished:
+                    self._write_event({"type": "heartbeat", "status": job.status})
+
+                if finished:
+                    self._write_event({"type": "status", **job.to_dict()})
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def _write_event(self, event: Dict[str, Any]) -> None:
+        self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    project_root: Path,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_path: Optional[str] = None,
+    max_finished_jobs: int = DEFAULT_MAX_FINISHED_JOBS,
+) -> None:
+    """启动常驻任务服务（阻塞直到 Ctrl+C）。"""
+    job_server = JobServer(project_root, max_finished_jobs)
+    job_server.warm_up()
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        httpd = _ThreadingUnixHTTPServer(socket_path, _Handler)
+        where = f"unix:{socket_path}"
+    else:
+        httpd = ThreadingHTTPServer((host, port), _Handler)
+        httpd.daemon_threads = True
+        where = f"http://{host}:{port}"
+    httpd.job_server = job_server
+
+    job_server.start()
+    print(f"[INFO] Job server listening on {where} (project root: {project_root})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[INFO] Shutting down job server.")
+    finally:
+        httpd.server_close()
+        sys.stdout = job_server.output.original
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
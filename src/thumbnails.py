@@ -0,0 +1,179 @@
+from __future__ import annotations
+import hashlib
+import json
+import math
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from PIL import Image, ImageDraw
+
+# === 缩略图金字塔缓存 ===
+#
+# 每张 panel 图生成后立刻做一组缩略图（默认 1024 / 512 / 256，逐级从上一级缩小），
+# 按源文件内容的 sha256 存放：
+#     output/thumbnails/<sha[:2]>/<sha>/256.jpg
+# 源文件内容不变就不会重建；每个源文件有一个小的 sidecar 记录 (size, mtime, sha256)：
+#     output/thumbnails/sources/<hash(源路径)[:2]>/<hash(源路径)>.json
+# 文件没动过时连 hash 都不用重新算。每个源文件各写各的 sidecar（原子替换），
+# 多个 step 3 worker 进程同时出图也不会互相覆盖。
+#
+# contact sheet（整章缩略图拼图）只读取最小一级缩略图，几十张 panel 也能在一秒内拼完。
+
+THUMBNAIL_LEVELS = (256, 512, 1024)
+THUMBNAIL_DIRNAME = "thumbnails"
+_SOURCES_DIRNAME = "sources"
+_JPEG_QUALITY = 85
+
+
+def default_cache_dir(project_root: Path) -> Path:
+    return project_root / "output" / THUMBNAIL_DIRNAME
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sidecar_path(cache_dir: Path, key: str) -> Path:
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return cache_dir / _SOURCES_DIRNAME / digest[:2] / f"{digest}.json"
+
+
+def _tmp_suffix() -> str:
+    # 同一目录下多个进程 / 线程各用各的临时文件，再 os.replace 原子替换
+    return f"{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def source_hash(image_path: str | Path, cache_dir: Path) -> str:
+    """返回源图内容 hash；size / mtime 与 sidecar 记录一致时直接用缓存值。"""
+    image_path = Path(image_path).resolve()
+    st = image_path.stat()
+    key = str(image_path)
+    sidecar = _sidecar_path(cache_dir, key)
+
+    try:
+        entry = json.loads(sidecar.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        entry = None
+    if (
+        isinstance(entry, dict)
+        and entry.get("path") == key
+        and entry.get("size") == st.st_size
+        and entry.get("mtime_ns") == st.st_mtime_ns
+    ):
+        return str(entry["sha256"])
+
+    sha = _file_sha256(image_path)
+    sidecar.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = sidecar.with_name(f"{sidecar.name}.{_tmp_suffix()}")
+    tmp_path.write_text(
+        json.dumps({"path": key, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha}, ensure_ascii=False),
+        encoding="utf-8",
+    )
+    os.replace(tmp_path, sidecar)
+    return sha
+
+
+def thumbnail_path(cache_dir: Path, sha: str, level: int) -> Path:
+    return cache_dir / sha[:2] / sha / f"{level}.jpg"
+
+
+def build_thumbnail_pyramid(
+    image_path: str | Path,
+    cache_dir: Path,
+    levels: Sequence[int] = THUMBNAIL_LEVELS,
+) -> Dict[int, Path]:
+    """
+    为一张图生成缩略图金字塔，返回 {边长: 缩略图路径}。
+    已存在（同内容 hash）的级别不会重新生成。
+    """
+    sha = source_hash(image_path, cache_dir)
+    paths = {level: thumbnail_path(cache_dir, sha, level) for level in levels}
+    missing = [level for level, p in paths.items() if not p.exists()]
+    if not missing:
+        return paths
+
+    paths[missing[0]].parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(image_path) as source:
+        current = source.convert("RGB")
+
+    # 从大到小逐级缩放：每一级都从上一级缩，比每次都从 2048 原图缩快得多
+    for level in sorted(levels, reverse=True):
+        if max(current.size) > level:
+            current = current.copy()
+            current.thumbnail((level, level), Image.LANCZOS)
+        if level in missing:
+            tmp_path = paths[level].with_name(f"{level}.{_tmp_suffix()}.jpg")
+            current.save(tmp_path, "JPEG", quality=_JPEG_QUALITY)
+            os.replace(tmp_path, paths[level])
+
+    return paths
+
+
+def get_thumbnail_path(image_path: str | Path, level: int, cache_dir: Path) -> Path:
+    """返回指定级别的缩略图路径，缓存缺失时自动生成整组金字塔。"""
+    levels = tuple(sorted(set(THUMBNAIL_LEVELS) | {level}))
+    return build_thumbnail_pyramid(image_path, cache_dir, levels)[level]
+
+
+def build_contact_sheet(
+    image_paths: Iterable[str | Path],
+    output_path: str | Path,
+    cache_dir: Path,
+    level: int = THUMBNAIL_LEVELS[0],
+    columns: int = 6,
+    labels: Optional[Sequence[str]] = None,
+    padding: int = 8,
+) -> Path:
+    """
+    用最小一级缩略图把一组 panel 拼成一张总览图（contact sheet）。
+
+    labels: 每张图左上角的标注（默认用文件名）
+    """
+    image_paths = [Path(p) for p in image_paths]
+    if not image_paths:
+        raise ValueError("没有可以拼接的图片。")
+    labels = list(labels) if labels is not None else [p.stem for p in image_paths]
+
+    rows = math.ceil(len(image_paths) / columns)
+    cell = level + padding
+    sheet = Image.new("RGB", (columns * cell + padding, rows * cell + padding), (24, 24, 24))
+    draw = ImageDraw.Draw(sheet)
+
+    for i, (path, label) in enumerate(zip(image_paths, labels)):
+        x = padding + (i % columns) * cell
+        y = padding + (i // columns) * cell
+        with Image.open(get_thumbnail_path(path, level, cache_dir)) as thumb:
+            # 非正方形的图在格子里居中
+            sheet.paste(thumb, (x + (level - thumb.width) // 2, y + (level - thumb.height) // 2))
+        draw.rectangle((x, y, x + 6 * len(label) + 6, y + 14), fill=(0, 0, 0))
+        draw.text((x + 3, y + 2), label, fill=(255, 255, 255))
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    sheet.save(output_path)
+    return output_path
+
+
+def collect_panel_images(project_root: Path) -> List[Path]:
+    """
+    按 panel 顺序收集已生成的图片：优先读 final_comic_data_with_images.json，
+    没有时退回扫描 output/comic_images/panel_*.png。
+    """
+    final_path = project_root / "output" / "final_comic_data_with_images.json"
+    if final_path.exists():
+        comic_data = json.loads(final_path.read_text(encoding="utf-8"))
+        paths = [
+            project_root / panel["generated_image_path"]
+            for panel in comic_data
+            if panel.get("generated_image_path")
+        ]
+        paths = [p for p in paths if p.exists()]
+        if paths:
+            return paths
+    return sorted((project_root / "output" / "comic_images").glob("panel_*.png"))
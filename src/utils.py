@@ -1,26 +1,46 @@
 
 import os
+from pathlib import Path
 from PIL import Image
 
+from .chapter_index import read_chapters
+from .thumbnails import THUMBNAIL_DIRNAME, get_thumbnail_path
+
 def load_image_from_path(image_path: str) -> Image.Image:
     """Loads an image from a given file path."""
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found at: {image_path}")
     return Image.open(image_path)
 
+def load_image_thumbnail(image_path: str, level: int = 512, cache_dir: str | None = None) -> Image.Image:
+    """
+    Loads a cached thumbnail (256/512/1024) of an image instead of the full-size file.
+
+    The thumbnail pyramid is built on first use and rebuilt only when the source
+    content changes. `cache_dir` defaults to output/thumbnails next to output/comic_images.
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image file not found at: {image_path}")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(image_path))), THUMBNAIL_DIRNAME)
+    return Image.open(get_thumbnail_path(image_path, level, Path(cache_dir)))
+
 def save_image_to_path(image: Image.Image, save_path: str):
     """Saves a PIL Image object to the specified path."""
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
     image.save(save_path)
     # print(f"Image saved to: {save_path}")
 
-def load_novel_text(file_path: str) -> str:
-    """Loads text content from a file."""
+def load_novel_text(file_path: str, chapters: str | None = None) -> str:
+    """
+    Loads text content from a file.
+
+    If `chapters` is given (e.g. "120-135"), only those chapters are read
+    through the memory-mapped chapter index instead of the whole file.
+    """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Novel text file not found at: {file_path}")
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    return content
+    return read_chapters(file_path, chapters)
 from pathlib import Path
 import yaml
 from typing import Dict
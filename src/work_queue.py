@@ -0,0 +1,337 @@
+from __future__ import annotations
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .api_client import get_image_client
+from .comic_generator import render_panel_image, save_final_comic_data
+
+# === STEP 3 多进程 / 多机工作队列 ===
+#
+# 每个 panel 是队列里的一个任务，状态：pending -> leased -> done / failed
+# （没有 generated_image_description 的 panel 记为 skipped）。
+# worker 领取任务时拿到一个有过期时间的租约（lease），渲染期间后台线程定期心跳续约；
+# worker 崩溃后租约过期，任务会被其他 worker 自动重新领取。
+#
+# 队列存在一个 SQLite 文件里（默认 output/step3_queue.sqlite）：
+#   - 同一台机器上的多个进程：默认 WAL 模式即可
+#   - 多台机器共享存储（NFS 等）：WAL 依赖共享内存，不能跨机器，
+#     需要用 --queue-journal-mode delete，并保证共享存储支持文件锁
+#
+# 典型用法：
+#   python -m src.cli --step 3 --queue enqueue
+#   python -m src.cli --step 3 --queue work      # 在任意多个进程 / 机器上各跑一个
+#   python -m src.cli --step 3 --queue status
+#   python -m src.cli --step 3 --queue export    # 汇总成 final_comic_data_with_images.json
+
+DEFAULT_QUEUE_FILENAME = "step3_queue.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS panels (
+    panel_number INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    panel TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    image_path TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_panels_claim ON panels (state, position);
+"""
+
+
+def default_queue_path(project_root: Path) -> Path:
+    return project_root / "output" / DEFAULT_QUEUE_FILENAME
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class PanelWorkQueue:
+    def __init__(
+        self,
+        db_path: str | Path,
+        lease_seconds: float = 300.0,
+        max_attempts: int = 3,
+        journal_mode: str = "wal",
+    ):
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.journal_mode = journal_mode
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # 每次操作单独连接：心跳线程和主线程互不干扰，也不会长时间占着锁
+        conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA busy_timeout = 30000")
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # --- producer ---
+
+    def enqueue(self, comic_data: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """
+        把 panel 放进队列，返回 (新加入数, 更新数)，可以安全地重复执行：
+        - 新 panel 直接加入
+        - 已在队列里但内容变了（例如重新跑过 step 2）的 panel 更新内容并重置为待渲染
+        - 内容没变但之前 failed 的 panel 重置为待渲染，重新尝试
+        - 正在被领取（leased）且内容没变的 panel 不动
+        """
+        now = time.time()
+        added = 0
+        updated = 0
+        with self._transaction() as conn:
+            for i, panel in enumerate(comic_data):
+                panel_number = panel.get("panel_number", i + 1)
+                state = "pending"
+                if not panel.get("generated_image_description"):
+                    # 仍然入库（状态 skipped），export 时保持和顺序执行一样的完整 panel 列表
+                    print(f"Skipping panel {panel_number}: No generated_image_description found.")
+                    state = "skipped"
+                panel_json = json.dumps(panel, ensure_ascii=False)
+
+                row = conn.execute(
+                    "SELECT panel, state FROM panels WHERE panel_number = ?", (panel_number,)
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO panels (panel_number, position, panel, state, updated_at)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (panel_number, i, panel_json, state, now),
+                    )
+                    added += 1
+                    continue
+
+                old_json, old_state = row
+                if old_json != panel_json or old_state == "failed":
+                    conn.execute(
+                        "UPDATE panels SET panel = ?, position = ?, state = ?, attempts = 0,"
+                        " lease_owner = NULL, lease_expires = NULL, image_path = NULL, error = NULL,"
+                        " updated_at = ? WHERE panel_number = ?",
+                        (panel_json, i, state, now, panel_number),
+                    )
+                    updated += 1
+                else:
+                    conn.execute(
+                        "UPDATE panels SET position = ? WHERE panel_number = ? AND position != ?",
+                        (i, panel_number, i),
+                    )
+        return added, updated
+
+    # --- worker ---
+
+    def claim(self, worker_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """领取一个待处理（或租约已过期）的 panel，没有可领取的任务时返回 None。"""
+        now = time.time()
+        with self._transaction() as conn:
+            # 超过最大尝试次数、且租约已过期的任务直接判失败，避免一直卡住队列
+            conn.execute(
+                "UPDATE panels SET state = 'failed', error = COALESCE(error, 'lease expired'), updated_at = ?"
+                " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT panel_number, panel FROM panels"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)"
+                " ORDER BY position LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            panel_number, panel_json = row
+            conn.execute(
+                "UPDATE panels SET state = 'leased', lease_owner = ?, lease_expires = ?,"
+                " attempts = attempts + 1, updated_at = ? WHERE panel_number = ?",
+                (worker_id, now + self.lease_seconds, now, panel_number),
+            )
+        return panel_number, json.loads(panel_json)
+
+    def heartbeat(self, panel_number: int, worker_id: str) -> bool:
+        """续约；返回 False 表示租约已经丢失（过期后被别的 worker 领走）。"""
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE panels SET lease_expires = ?, updated_at = ?"
+                " WHERE panel_number = ? AND state = 'leased' AND lease_owner = ?",
+                (now + self.lease_seconds, now, panel_number, worker_id),
+            )
+            return cur.rowcount == 1
+
+    def complete(self, panel_number: int, worker_id: str, image_path: str) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE panels SET state = 'done', image_path = ?, error = NULL, lease_owner = NULL,"
+                " lease_expires = NULL, updated_at = ?"
+                " WHERE panel_number = ? AND state = 'leased' AND lease_owner = ?",
+                (image_path, now, panel_number, worker_id),
+            )
+            return cur.rowcount == 1
+
+    def fail(self, panel_number: int, worker_id: str, error: str) -> None:
+        """记录失败；还没到 max_attempts 时放回 pending 等待重试。"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE panels SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,"
+                " error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ?"
+                " WHERE panel_number = ? AND state = 'leased' AND lease_owner = ?",
+                (self.max_attempts, error, now, panel_number, worker_id),
+            )
+
+    # --- inspection ---
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM panels GROUP BY state").fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0, "skipped": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def has_unfinished(self) -> bool:
+        counts = self.counts()
+        return counts["pending"] + counts["leased"] > 0
+
+    def results(self) -> List[Dict[str, Any]]:
+        """按原顺序返回所有 panel，已完成的带上 generated_image_path。"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT panel, state, image_path, error FROM panels ORDER BY position"
+            ).fetchall()
+        panels = []
+        for panel_json, state, image_path, error in rows:
+            panel = json.loads(panel_json)
+            if state == "done" and image_path:
+                panel["generated_image_path"] = image_path
+            panels.append(panel)
+        return panels
+
+    def failures(self) -> List[Tuple[int, str]]:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT panel_number, error FROM panels WHERE state = 'failed' ORDER BY position"
+            ).fetchall()
+
+
+class _Heartbeat:
+    """渲染期间在后台线程里定期续约。"""
+
+    def __init__(self, queue: PanelWorkQueue, panel_number: int, worker_id: str):
+        self.queue = queue
+        self.panel_number = panel_number
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        interval = max(self.queue.lease_seconds / 3, 1.0)
+        while not self._stop.wait(interval):
+            try:
+                if not self.queue.heartbeat(self.panel_number, self.worker_id):
+                    self.lost = True
+                    print(f"[WARN] Lost lease on panel {self.panel_number}.")
+                    return
+            except sqlite3.Error as e:
+                print(f"[WARN] Heartbeat failed for panel {self.panel_number}: {e}")
+
+    def __enter__(self) -> "_Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    project_root: Path,
+    queue: PanelWorkQueue,
+    worker_id: Optional[str] = None,
+    reference_images: Dict[str, str] | None = None,
+    image_output_dir_name: str = "comic_images",
+    poll_seconds: float = 5.0,
+) -> int:
+    """
+    持续领取并渲染 panel，直到队列里没有 pending / leased 任务为止。
+    别的 worker 还持有租约时会继续轮询，以便接手它们崩溃后过期的任务。
+    返回本 worker 完成的 panel 数量。
+    """
+    worker_id = worker_id or default_worker_id()
+    reference_images = reference_images or {}
+
+    image_client = get_image_client()
+    output_dir = project_root / 'output' / image_output_dir_name
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"=== STEP 3 worker {worker_id}: queue {queue.db_path} ===")
+    completed = 0
+    while True:
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            if not queue.has_unfinished():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        panel_number, panel = claimed
+        try:
+            with _Heartbeat(queue, panel_number, worker_id):
+                image_path = render_panel_image(
+                    image_client, project_root, output_dir, panel, panel_number, reference_images
+                )
+        except Exception as e:
+            print(f"Error generating image for panel {panel_number}: {e}")
+            queue.fail(panel_number, worker_id, f"{type(e).__name__}: {e}")
+            continue
+
+        if not image_path:
+            print(f"Failed to generate image for panel {panel_number}. Image client returned None.")
+            queue.fail(panel_number, worker_id, "image client returned None")
+        elif queue.complete(panel_number, worker_id, image_path):
+            completed += 1
+            print(f"Successfully generated and saved image for panel {panel_number} to {image_path}")
+        else:
+            print(f"[WARN] Panel {panel_number} rendered, but the lease was taken over by another worker.")
+
+    print(f"Worker {worker_id} finished: {completed} panels completed. Queue: {queue.counts()}")
+    return completed
+
+
+def export_results(project_root: Path, queue: PanelWorkQueue) -> Path:
+    """把队列里的结果汇总写成 final_comic_data_with_images.json。"""
+    path = save_final_comic_data(project_root, queue.results())
+    for panel_number, error in queue.failures():
+        print(f"[WARN] Panel {panel_number} failed: {error}")
+    print(f"Updated comic data with image paths saved to {path}")
+    return path
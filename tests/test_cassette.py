@@ -0,0 +1,66 @@
+import pytest
+
+from src.cassette import Cassette, CassetteMiss
+
+SCHEMA = {"type": "ARRAY"}
+
+
+def _record(path):
+    cassette = Cassette(path, "record")
+    cassette.record("text", {"prompt": "拆分  分镜", "response_schema": SCHEMA}, {"text": "panels"})
+    cassette.record("text", {"prompt": "描述 panel 1", "response_schema": None}, {"text": "desc 1"})
+    cassette.record("text", {"prompt": "描述 panel 1", "response_schema": None}, {"text": "desc 1 again"})
+    cassette.record("image", {"prompt": "p", "reference_images": [], "params": {}}, {"type": "file"}, b"\x89PNG")
+    cassette.close()
+
+
+def test_strict_lookup_returns_recorded_responses_in_order(tmp_path):
+    path = tmp_path / "cassette.sqlite"
+    _record(path)
+    cassette = Cassette(path, "replay")
+
+    request = {"prompt": "描述 panel 1", "response_schema": None}
+    assert cassette.lookup("text", request)[0]["text"] == "desc 1"
+    assert cassette.lookup("text", request)[0]["text"] == "desc 1 again"
+    # 调用次数比录制的多时重复最后一条
+    assert cassette.lookup("text", request)[0]["text"] == "desc 1 again"
+
+    response, payload = cassette.lookup("image", {"prompt": "p", "reference_images": [], "params": {}})
+    assert response == {"type": "file"}
+    assert payload == b"\x89PNG"
+
+
+def test_strict_lookup_misses_on_changed_prompt(tmp_path):
+    path = tmp_path / "cassette.sqlite"
+    _record(path)
+    cassette = Cassette(path, "replay")
+    with pytest.raises(CassetteMiss):
+        cassette.lookup("text", {"prompt": "拆分 分镜", "response_schema": SCHEMA})
+
+
+def test_lenient_lookup_normalizes_whitespace_and_warns(tmp_path, capsys):
+    path = tmp_path / "cassette.sqlite"
+    _record(path)
+    cassette = Cassette(path, "replay", "lenient")
+
+    response, _ = cassette.lookup("text", {"prompt": "拆分 分镜\n", "response_schema": SCHEMA})
+    assert response["text"] == "panels"
+    assert "[WARN]" in capsys.readouterr().out
+
+
+def test_lenient_fallback_stays_within_the_same_response_schema(tmp_path):
+    path = tmp_path / "cassette.sqlite"
+    _record(path)
+    cassette = Cassette(path, "replay", "lenient")
+
+    # 措辞完全变了：只能按录制顺序兜底，且只会拿到 response_schema 相同的记录
+    assert cassette.lookup("text", {"prompt": "新的拆分模板", "response_schema": SCHEMA})[0]["text"] == "panels"
+    with pytest.raises(CassetteMiss):
+        cassette.lookup("text", {"prompt": "再来一次", "response_schema": SCHEMA})
+
+    assert cassette.lookup("text", {"prompt": "新的描述模板", "response_schema": None})[0]["text"] == "desc 1"
+
+
+def test_replay_requires_existing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Cassette(tmp_path / "missing.sqlite", "replay")
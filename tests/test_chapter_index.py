@@ -0,0 +1,70 @@
+from src.chapter_index import (
+    build_chapter_index,
+    index_path_for,
+    load_chapter_index,
+    parse_chapter_selection,
+    read_chapters,
+)
+
+NOVEL = "第一章 启程\n港口的清晨。\n第二章 夜航\n船在夜里出发。\n第三章 归来\n终于回到了港口。\n"
+
+
+def _write(tmp_path, text, bom=False):
+    path = tmp_path / "novel.txt"
+    path.write_bytes((b"\xef\xbb\xbf" if bom else b"") + text.encode("utf-8"))
+    return path
+
+
+def test_heading_on_first_line_after_bom(tmp_path):
+    path = _write(tmp_path, NOVEL, bom=True)
+    chapters = build_chapter_index(path)
+    assert [c["number"] for c in chapters] == [1, 2, 3]
+    assert chapters[0]["start"] == 3
+    assert chapters[0]["title"] == "第一章 启程"
+
+
+def test_prologue_becomes_chapter_zero(tmp_path):
+    path = _write(tmp_path, "序\n楔子内容。\n" + NOVEL)
+    chapters = build_chapter_index(path)
+    assert [c["ordinal"] for c in chapters] == [0, 1, 2, 3]
+    assert chapters[0]["title"] == ""
+
+
+def test_long_cjk_title_is_kept(tmp_path):
+    title = "第十二章 " + "长" * 60
+    path = _write(tmp_path, title + "\n正文\n")
+    chapters = build_chapter_index(path)
+    assert chapters[0]["number"] == 12
+    assert chapters[0]["title"] == title
+
+
+def test_title_directly_after_heading(tmp_path):
+    path = _write(tmp_path, "第1章风起\n港口起风了。\n第2章云涌\n乌云压过来。\n第三回：归港\n")
+    chapters = build_chapter_index(path)
+    assert [(c["number"], c["title"]) for c in chapters] == [(1, "第1章风起"), (2, "第2章云涌"), (3, "第三回：归港")]
+    assert read_chapters(path, "2") == "第2章云涌\n乌云压过来。\n"
+
+
+def test_body_text_is_not_a_heading(tmp_path):
+    path = _write(tmp_path, "第一章 启程\n第一回合他就输了。\n")
+    assert len(build_chapter_index(path)) == 1
+
+
+def test_read_selected_chapters(tmp_path):
+    path = _write(tmp_path, NOVEL, bom=True)
+    assert read_chapters(path, "2-3") == "第二章 夜航\n船在夜里出发。\n第三章 归来\n终于回到了港口。\n"
+    assert read_chapters(path, "1") == "第一章 启程\n港口的清晨。\n"
+    assert read_chapters(path) == NOVEL
+
+
+def test_index_cache_is_written_and_invalidated(tmp_path):
+    path = _write(tmp_path, NOVEL)
+    assert len(load_chapter_index(path)) == 3
+    assert index_path_for(path).exists()
+
+    path.write_text(NOVEL + "第四章 尾声\n完。\n", encoding="utf-8")
+    assert len(load_chapter_index(path)) == 4
+
+
+def test_parse_chapter_selection():
+    assert parse_chapter_selection("1-5，8, 10-12") == [(1, 5), (8, 8), (10, 12)]
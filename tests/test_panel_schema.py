@@ -0,0 +1,103 @@
+import json
+
+from src.panel_schema import find_missing_spans, salvage_panels
+
+
+def _panel(n):
+    return {
+        "panel_number": n,
+        "scene_description": f"场景 {n}",
+        "characters": ["麟奈狸"],
+        "dialogue": [{"character": "麟奈狸", "line": "……"}],
+    }
+
+
+def test_salvage_valid_json_array():
+    raw = json.dumps([_panel(1), _panel(2)], ensure_ascii=False)
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1, 2]
+    assert broken == []
+    assert truncated is False
+
+
+def test_salvage_strips_code_fence():
+    raw = "```json\n" + json.dumps([_panel(1)], ensure_ascii=False) + "\n```"
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1]
+    assert not broken and not truncated
+
+
+def test_salvage_keeps_valid_panels_around_a_broken_one():
+    bad = {"panel_number": 2, "characters": "麟奈狸", "dialogue": []}
+    raw = json.dumps([_panel(1), bad, _panel(3)], ensure_ascii=False)
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1, 3]
+    assert broken == [2]
+    assert truncated is False
+
+
+def test_salvage_detects_truncated_output():
+    full = json.dumps([_panel(1), _panel(2), _panel(3)], ensure_ascii=False)
+    raw = full[: full.rindex('"scene_description"')]
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1, 2]
+    assert broken == [3]
+    assert truncated is True
+
+
+def test_salvage_unclosed_array_is_truncated():
+    raw = "[" + json.dumps(_panel(1), ensure_ascii=False) + ","
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1]
+    assert truncated is True
+
+
+def test_find_missing_spans():
+    panels = [_panel(1), _panel(2), _panel(5)]
+    assert find_missing_spans(panels, [6]) == [(3, 4), (6, 6)]
+
+
+def test_find_missing_spans_complete():
+    assert find_missing_spans([_panel(1), _panel(2)], []) == []
+
+
+def _alphabetical(panel):
+    # 带 response_schema 时 Gemini 默认按字母序输出字段
+    return dict(sorted(panel.items()))
+
+
+def test_salvage_does_not_depend_on_key_order():
+    bad = '{"characters": ["麟奈狸"], "dialogue": [], "panel_number": 2, "scene_description": "断" "开"}'
+    raw = "[" + ",".join([
+        json.dumps(_alphabetical(_panel(1)), ensure_ascii=False),
+        bad,
+        json.dumps(_alphabetical(_panel(3)), ensure_ascii=False),
+    ]) + "]"
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1, 3]
+    assert broken == [2]
+    assert truncated is False
+
+
+def test_salvage_resyncs_after_unterminated_string():
+    bad = '{"characters": [], "dialogue": [], "panel_number": 2, "scene_description": "没有闭合}'
+    raw = "[" + ",".join([
+        json.dumps(_alphabetical(_panel(1)), ensure_ascii=False),
+        bad,
+        json.dumps(_alphabetical(_panel(3)), ensure_ascii=False),
+        json.dumps(_alphabetical(_panel(4)), ensure_ascii=False),
+    ]) + "]"
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["panel_number"] for p in panels] == [1, 3, 4]
+    assert broken == [2]
+    assert truncated is False
+
+
+def test_salvage_braces_inside_strings():
+    panel = _panel(1)
+    panel["dialogue"] = [{"character": "麟奈狸", "line": "}{]["}]
+    raw = "[" + json.dumps(_alphabetical(panel), ensure_ascii=False) + ', {"panel_number": 2'
+    panels, broken, truncated = salvage_panels(raw)
+    assert [p["dialogue"][0]["line"] for p in panels] == ["}{]["]
+    assert broken == [2]
+    assert truncated is True
@@ -0,0 +1,95 @@
+import json
+
+import yaml
+
+from src import api_client
+from src.cli import step2_generate_image_descriptions
+from src.scene_dedup import SceneIndex, choose_bands, jaccard, lsh_recall, panel_shingles
+
+HARBOUR = "清晨的港口，渔船陆续出海，海鸥在桅杆之间盘旋"
+
+
+def _panel(scene, characters=("麟奈狸",)):
+    return {"scene_description": scene, "characters": list(characters), "dialogue": []}
+
+
+def test_shingles_ignore_punctuation():
+    assert panel_shingles(_panel(HARBOUR)) == panel_shingles(_panel(HARBOUR + "！"))
+
+
+def test_query_finds_near_duplicate():
+    index = SceneIndex(0.8)
+    index.add(1, _panel(HARBOUR))
+    index.add(2, _panel("夜晚的船舱里，油灯摇晃", ["船长"]))
+
+    key, similarity = index.query(_panel(HARBOUR + "。"))
+    assert key == 1
+    assert similarity == 1.0
+    assert index.query(_panel("山顶的寺庙里钟声回荡", ["老僧"])) is None
+
+
+def test_query_respects_threshold():
+    a = _panel(HARBOUR)
+    b = _panel("清晨的港口，渔船陆续出海，远处传来汽笛声")
+    similarity = jaccard(panel_shingles(a), panel_shingles(b))
+
+    index = SceneIndex(min(similarity + 0.05, 1.0))
+    index.add(1, a)
+    assert index.query(b) is None
+
+
+def test_bands_are_derived_from_threshold():
+    assert choose_bands(0.8, 64) == 16
+    assert choose_bands(0.5, 64) == 32
+    for threshold in (0.5, 0.7, 0.8, 0.9):
+        index = SceneIndex(threshold)
+        assert index.bands * index.rows == index.num_perm
+        assert lsh_recall(threshold, index.bands, index.rows) >= 0.99
+
+
+class _FakeTextClient:
+    def __init__(self):
+        self.calls = 0
+        self.last_token_count = None
+
+    def generate_text(self, prompt, response_schema=None):
+        self.calls += 1
+        return f"image prompt #{self.calls}"
+
+
+def test_step2_reuses_descriptions_for_near_duplicates(tmp_path, monkeypatch):
+    panels = [
+        {"panel_number": 1, **_panel(HARBOUR)},
+        {"panel_number": 2, **_panel("夜晚的船舱里，油灯摇晃", ["船长"])},
+        {"panel_number": 3, **_panel(HARBOUR + "！")},
+    ]
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "novel.txt").write_text("第一章 启程\n港口的清晨。\n", encoding="utf-8")
+    (tmp_path / "output").mkdir()
+    with (tmp_path / "output" / "comic_panels_draft.yaml").open("w", encoding="utf-8") as f:
+        yaml.safe_dump(panels, f, allow_unicode=True, sort_keys=False)
+
+    fake = _FakeTextClient()
+    monkeypatch.setattr(api_client, "_text_client_instance", fake)
+    step2_generate_image_descriptions(tmp_path, dedup_threshold=0.8)
+
+    result = json.loads((tmp_path / "output" / "generated_comic_data.json").read_text(encoding="utf-8"))
+    assert fake.calls == 2
+    assert [p["generated_image_description"] for p in result] == [
+        "image prompt #1",
+        "image prompt #2",
+        "image prompt #1",
+    ]
+    assert result[2]["dedup_source_panel"] == 1
+    assert "dedup_source_panel" not in result[1]
+
+
+def test_different_cast_is_never_a_duplicate():
+    index = SceneIndex(0.8)
+    index.add(1, _panel(HARBOUR, ["麟奈狸"]))
+
+    assert index.query(_panel(HARBOUR, ["某村民", "港口守卫"])) is None
+    assert index.query(_panel(HARBOUR, ["麟奈狸", "港口守卫"])) is None
+    # 角色顺序 / 重复不影响
+    index.add(2, _panel(HARBOUR, ["某村民", "港口守卫"]))
+    assert index.query(_panel(HARBOUR, ["港口守卫", "某村民", "某村民"]))[0] == 2
@@ -0,0 +1,240 @@
+import json
+
+import pytest
+import yaml
+from PIL import Image
+
+from src import api_client
+from src.cli import build_scheduler, step2_generate_image_descriptions, step3_generate_comic_images
+from src.scheduler import PanelScheduler, RunBudget, estimate_tokens, parse_priority_weights
+
+HARBOUR = "清晨的港口，渔船陆续出海，海鸥在桅杆之间盘旋"
+CABIN = "夜晚的船舱里，油灯摇晃"
+
+
+def _panel(n, scene, characters, **extra):
+    return {"panel_number": n, "scene_description": scene, "characters": characters, "dialogue": [], **extra}
+
+
+class _FakeTextClient:
+    def __init__(self, tokens=50):
+        self.tokens = tokens
+        self.prompts = []
+        self.last_token_count = None
+
+    def generate_text(self, prompt, response_schema=None):
+        self.prompts.append(prompt)
+        self.last_token_count = self.tokens
+        return f"image prompt #{len(self.prompts)}"
+
+
+class _FakeImageClient:
+    def __init__(self):
+        self.calls = []
+
+    def generate_image(self, prompt, output_path=None, reference_images=None, **kwargs):
+        self.calls.append((prompt, kwargs))
+        Image.new("RGB", (64, 64), (len(self.calls) * 40, 0, 0)).save(output_path)
+        return output_path
+
+
+@pytest.fixture
+def project_root(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "novel.txt").write_text("第一章 启程\n港口的清晨。\n", encoding="utf-8")
+    (tmp_path / "output").mkdir()
+    return tmp_path
+
+
+def _write_panels(project_root, panels):
+    with (project_root / "output" / "comic_panels_draft.yaml").open("w", encoding="utf-8") as f:
+        yaml.safe_dump(panels, f, allow_unicode=True, sort_keys=False)
+
+
+def _read_json(path):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+# --- PanelScheduler / RunBudget ---
+
+def test_order_by_score_with_stable_ties():
+    scheduler = PanelScheduler(named_characters=["麟奈狸"])
+    panels = [
+        _panel(1, "a", ["某村民"]),
+        _panel(2, "b", ["麟奈狸"]),
+        _panel(3, "c", []),
+        _panel(4, "d", [], priority=1),
+        _panel(5, "e", ["麟奈狸", "某村民"]),
+    ]
+    # 4: 显式 priority 10 分；2、5: 一个重要角色 3 分（同分保持原顺序）；1、3: 0 分
+    assert [i for i, _ in scheduler.order(panels)] == [3, 1, 4, 0, 2]
+
+
+def test_custom_weights():
+    scheduler = PanelScheduler(weights=parse_priority_weights("characters=0,dialogue=5"))
+    panels = [_panel(1, "a", ["甲", "乙"]), _panel(2, "b", [])]
+    panels[1]["dialogue"] = [{"character": "甲", "line": "……"}]
+    assert [i for i, _ in scheduler.order(panels)] == [1, 0]
+    with pytest.raises(ValueError):
+        parse_priority_weights("unknown=1")
+
+
+def test_budget_stop_reasons():
+    budget = RunBudget(max_tokens=100, max_images=1)
+    assert budget.stop_reason(needs_tokens=True, needs_image=True) is None
+
+    budget.charge_tokens(100)
+    assert "token budget" in budget.stop_reason(needs_tokens=True)
+    assert budget.stop_reason(needs_image=True) is None
+
+    budget.charge_image()
+    assert "image budget" in budget.stop_reason(needs_image=True)
+    assert budget.to_dict()["tokens_used"] == 100
+    assert budget.to_dict()["images_used"] == 1
+
+
+def test_deadline_stops_everything():
+    budget = RunBudget(deadline_seconds=0)
+    assert "deadline" in budget.stop_reason()
+
+
+def test_build_scheduler_only_when_configured(project_root):
+    assert build_scheduler(project_root) is None
+    scheduler = build_scheduler(project_root, priority_characters="麟奈狸，船长", max_tokens=10)
+    assert scheduler.named_characters == {"麟奈狸", "船长"}
+    assert scheduler.budget.max_tokens == 10
+
+
+def test_estimate_tokens_counts_cjk_per_character():
+    assert estimate_tokens("港口") == 2
+    assert estimate_tokens("abcdefgh") == 2
+
+
+# --- step 2 ---
+
+def test_step2_stops_on_token_budget_but_still_reuses(project_root, monkeypatch):
+    _write_panels(project_root, [
+        _panel(1, HARBOUR, ["麟奈狸"], priority=2),
+        _panel(2, CABIN, ["船长"]),
+        _panel(3, HARBOUR + "！", ["麟奈狸"]),
+    ])
+    fake = _FakeTextClient(tokens=150)
+    monkeypatch.setattr(api_client, "_text_client_instance", fake)
+
+    scheduler = PanelScheduler(budget=RunBudget(max_tokens=100))
+    step2_generate_image_descriptions(project_root, dedup_threshold=0.8, scheduler=scheduler)
+
+    assert len(fake.prompts) == 1
+    result = _read_json(project_root / "output" / "generated_comic_data.json")
+    assert [p.get("generated_image_description") for p in result] == ["image prompt #1", None, "image prompt #1"]
+
+    report = _read_json(project_root / "output" / "schedule_report_step2.json")
+    assert report["step"] == 2
+    assert "token budget of 100" in report["stopped_reason"]
+    assert report["completed"] == [1, 3]
+    assert report["remaining"] == [2]
+    assert report["budget"]["tokens_used"] == 150
+
+
+def test_step2_resume_skips_only_carried_panels(project_root, monkeypatch):
+    _write_panels(project_root, [_panel(1, HARBOUR, ["麟奈狸"]), _panel(2, CABIN, ["船长"])])
+    fake = _FakeTextClient(tokens=150)
+    monkeypatch.setattr(api_client, "_text_client_instance", fake)
+    step2_generate_image_descriptions(project_root, scheduler=PanelScheduler(budget=RunBudget(max_tokens=100)))
+    assert len(fake.prompts) == 1
+
+    step2_generate_image_descriptions(project_root, resume=True)
+    assert len(fake.prompts) == 2
+    assert CABIN in fake.prompts[1]
+
+    # 场景改过的 panel 不沿用旧描述
+    _write_panels(project_root, [_panel(1, HARBOUR + "，雾很大", ["麟奈狸"]), _panel(2, CABIN, ["船长"])])
+    step2_generate_image_descriptions(project_root, resume=True)
+    assert len(fake.prompts) == 3
+    assert "雾很大" in fake.prompts[2]
+
+
+def test_step2_without_resume_regenerates_stale_descriptions(project_root, monkeypatch):
+    _write_panels(project_root, [
+        _panel(1, HARBOUR, ["麟奈狸"], generated_image_description="stale"),
+        _panel(2, CABIN, ["船长"]),
+    ])
+    fake = _FakeTextClient()
+    monkeypatch.setattr(api_client, "_text_client_instance", fake)
+    step2_generate_image_descriptions(project_root)
+
+    assert len(fake.prompts) == 2
+    result = _read_json(project_root / "output" / "generated_comic_data.json")
+    assert [p["generated_image_description"] for p in result] == ["image prompt #1", "image prompt #2"]
+
+
+# --- step 3 ---
+
+def _write_comic_data(project_root, panels):
+    path = project_root / "output" / "generated_comic_data.json"
+    path.write_text(json.dumps(panels, ensure_ascii=False), encoding="utf-8")
+
+
+def test_step3_stops_on_image_budget_but_still_reuses(project_root, monkeypatch):
+    _write_comic_data(project_root, [
+        _panel(1, HARBOUR, ["麟奈狸"], generated_image_description="harbour"),
+        _panel(2, CABIN, ["船长"], generated_image_description="cabin"),
+        _panel(3, HARBOUR, ["麟奈狸"], generated_image_description="harbour",
+               dedup_source_panel=1, dedup_similarity=1.0),
+    ])
+    fake = _FakeImageClient()
+    monkeypatch.setattr(api_client, "_image_client_instance", fake)
+
+    scheduler = PanelScheduler(budget=RunBudget(max_images=1))
+    step3_generate_comic_images(project_root, reuse_image_threshold=0.95, scheduler=scheduler)
+
+    assert len(fake.calls) == 1
+    result = _read_json(project_root / "output" / "final_comic_data_with_images.json")
+    assert [p.get("generated_image_path") for p in result] == [
+        "output/comic_images/panel_001.png",
+        None,
+        "output/comic_images/panel_003.png",
+    ]
+    assert (project_root / "output" / "comic_images" / "panel_003.png").read_bytes() == \
+        (project_root / "output" / "comic_images" / "panel_001.png").read_bytes()
+
+    report = _read_json(project_root / "output" / "schedule_report_step3.json")
+    assert report["step"] == 3
+    assert report["stopped_reason"] == "image budget of 1 exhausted"
+    assert report["completed"] == [1, 3]
+    assert report["remaining"] == [2]
+    assert report["budget"]["images_used"] == 1
+
+
+def test_step3_rerenders_duplicates_with_another_seed(project_root, monkeypatch):
+    _write_comic_data(project_root, [
+        _panel(1, HARBOUR, ["麟奈狸"], generated_image_description="harbour"),
+        _panel(2, HARBOUR, ["麟奈狸"], generated_image_description="harbour",
+               dedup_source_panel=1, dedup_similarity=0.9),
+    ])
+    fake = _FakeImageClient()
+    monkeypatch.setattr(api_client, "_image_client_instance", fake)
+    step3_generate_comic_images(project_root)
+
+    assert [kwargs.get("seed") for _, kwargs in fake.calls] == [None, 2]
+
+
+def test_step3_resume_skips_only_carried_panels(project_root, monkeypatch):
+    panels = [
+        _panel(1, HARBOUR, ["麟奈狸"], generated_image_description="harbour"),
+        _panel(2, CABIN, ["船长"], generated_image_description="cabin"),
+    ]
+    _write_comic_data(project_root, panels)
+    fake = _FakeImageClient()
+    monkeypatch.setattr(api_client, "_image_client_instance", fake)
+    step3_generate_comic_images(project_root, scheduler=PanelScheduler(budget=RunBudget(max_images=1)))
+    assert len(fake.calls) == 1
+
+    step3_generate_comic_images(project_root, resume=True)
+    assert [prompt for prompt, _ in fake.calls] == ["harbour", "cabin"]
+
+    # 不加 --resume 时全部重新出图，即使输入里残留了图片路径
+    panels[0]["generated_image_path"] = "output/comic_images/panel_001.png"
+    _write_comic_data(project_root, panels)
+    step3_generate_comic_images(project_root)
+    assert [prompt for prompt, _ in fake.calls] == ["harbour", "cabin", "harbour", "cabin"]
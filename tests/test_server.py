@@ -0,0 +1,221 @@
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from src.server import JobServer, _Handler, parse_job_params
+
+
+def _fake_run_step(self, job):
+    print(f"step {job.step} for {job.id}")
+    print("done")
+    if job.params.get("chapters") == "999":
+        raise RuntimeError("boom")
+
+
+@pytest.fixture
+def make_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(JobServer, "_run_step", _fake_run_step)
+    started = []
+
+    def make(max_finished_jobs=200):
+        return JobServer(tmp_path, max_finished_jobs)
+
+    def start(job_server, worker=True):
+        if worker:
+            job_server.start()
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        httpd.daemon_threads = True
+        httpd.job_server = job_server
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        started.append((job_server, httpd))
+        return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    yield make, start
+
+    for job_server, httpd in started:
+        httpd.shutdown()
+        httpd.server_close()
+        if sys.stdout is job_server.output:
+            sys.stdout = job_server.output.original
+
+
+def _wait_done(job_server, jobs, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not all(job.done for job in jobs):
+        assert time.monotonic() < deadline, "jobs did not finish in time"
+        time.sleep(0.01)
+
+
+def _request(base, path, body=None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(base + path, data=data, method="POST" if data is not None else "GET")
+    try:
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return resp.status, resp.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+# --- 参数校验 ---
+
+def test_parse_job_params_converts_types():
+    params = parse_job_params({
+        "max_tokens": "100",
+        "max_images": 3,
+        "dedup_threshold": "0.8",
+        "deadline_seconds": 60,
+        "resume": "false",
+        "chapters": 120,
+        "priority_weights": "characters=2",
+        "panels_file": None,
+        "unknown": "ignored",
+    })
+    assert params == {
+        "max_tokens": 100,
+        "max_images": 3,
+        "dedup_threshold": 0.8,
+        "deadline_seconds": 60.0,
+        "resume": False,
+        "chapters": "120",
+        "priority_weights": "characters=2",
+    }
+    assert parse_job_params({"resume": True})["resume"] is True
+
+
+@pytest.mark.parametrize("data", [
+    {"max_tokens": "abc"},
+    {"max_tokens": 1.5},
+    {"max_images": -1},
+    {"max_images": True},
+    {"dedup_threshold": 1.5},
+    {"reuse_image_threshold": "high"},
+    {"resume": "maybe"},
+    {"resume": 1},
+    {"chapters": "1-x"},
+    {"priority_weights": "unknown=1"},
+    {"panels_file": ["a.yaml"]},
+])
+def test_parse_job_params_rejects_bad_values(data):
+    with pytest.raises(ValueError):
+        parse_job_params(data)
+
+
+# --- JobServer ---
+
+def test_jobs_run_by_priority_then_submission_order(make_server):
+    make, start = make_server
+    job_server = make()
+    jobs = [
+        job_server.submit(1, 0),
+        job_server.submit(2, 5),
+        job_server.submit(3, 0),
+        job_server.submit(1, 5),
+    ]
+    start(job_server)
+    _wait_done(job_server, jobs)
+
+    order = sorted(jobs, key=lambda job: job.started_at)
+    assert [job.id for job in order] == ["job-2", "job-4", "job-1", "job-3"]
+    assert all(job.status == "succeeded" for job in jobs)
+    assert jobs[0].log == ["step 1 for job-1", "done"]
+
+
+def test_failed_job_records_error(make_server):
+    make, start = make_server
+    job_server = make()
+    start(job_server)
+    job = job_server.submit(1, params={"chapters": "999"})
+    _wait_done(job_server, [job])
+
+    assert job.status == "failed"
+    assert job.error == "RuntimeError: boom"
+    assert any("RuntimeError: boom" in line for line in job.log)
+
+
+def test_finished_jobs_are_pruned(make_server):
+    make, start = make_server
+    job_server = make(max_finished_jobs=2)
+    start(job_server)
+    jobs = []
+    for _ in range(4):
+        job = job_server.submit(1)
+        _wait_done(job_server, [job])
+        jobs.append(job)
+
+    assert [job.id for job in job_server.snapshot()] == ["job-3", "job-4"]
+    assert job_server.get("job-1") is None
+
+
+def test_submit_rejects_unknown_step(make_server):
+    make, _ = make_server
+    with pytest.raises(ValueError):
+        make().submit(4)
+
+
+# --- HTTP API ---
+
+def test_http_submit_and_validation(make_server):
+    make, start = make_server
+    base = start(make())
+
+    status, body = _request(base, "/jobs", {"step": 2, "priority": 1, "max_tokens": "100", "resume": "false"})
+    assert status == 202
+    job = json.loads(body)
+    assert job["params"] == {"max_tokens": 100, "resume": False}
+
+    assert _request(base, "/jobs", {"step": 2, "max_tokens": "lots"})[0] == 400
+    assert _request(base, "/jobs", {"step": 7})[0] == 400
+    assert _request(base, "/jobs", ["not", "an", "object"])[0] == 400
+
+
+def test_http_cancel(make_server):
+    make, start = make_server
+    job_server = make()
+    # 不启动 worker，任务停在 queued
+    base = start(job_server, worker=False)
+    queued = job_server.submit(1)
+
+    status, body = _request(base, f"/jobs/{queued.id}/cancel", {})
+    assert status == 200 and json.loads(body)["status"] == "cancelled"
+    assert _request(base, f"/jobs/{queued.id}/cancel", {})[0] == 409
+    assert _request(base, "/jobs/job-99/cancel", {})[0] == 404
+
+
+def test_http_events_stream(make_server):
+    make, start = make_server
+    job_server = make()
+    base = start(job_server)
+    job = job_server.submit(1)
+    _wait_done(job_server, [job])
+
+    status, body = _request(base, f"/jobs/{job.id}/events")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert status == 200
+    assert [e["line"] for e in events if e["type"] == "log"] == [f"step 1 for {job.id}", "done"]
+    assert events[-1]["type"] == "status" and events[-1]["status"] == "succeeded"
+
+    _, body = _request(base, f"/jobs/{job.id}/events?since=1")
+    assert [json.loads(line).get("line") for line in body.splitlines()][:1] == ["done"]
+
+    assert _request(base, f"/jobs/{job.id}/events?since=abc")[0] == 400
+
+
+def test_http_lookup_and_not_found(make_server):
+    make, start = make_server
+    job_server = make()
+    base = start(job_server)
+    job = job_server.submit(3)
+    _wait_done(job_server, [job])
+
+    status, body = _request(base, "/jobs")
+    assert status == 200 and [j["id"] for j in json.loads(body)] == [job.id]
+    assert json.loads(_request(base, f"/jobs/{job.id}")[1])["status"] == "succeeded"
+    assert json.loads(_request(base, "/health")[1])["status"] == "ok"
+    assert _request(base, "/jobs/job-99")[0] == 404
+    assert _request(base, "/nope")[0] == 404
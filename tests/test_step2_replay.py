@@ -0,0 +1,70 @@
+import json
+
+import pytest
+import yaml
+
+from src import api_client
+from src.cassette import Cassette, RecordingTextClient, ReplayTextClient
+from src.cli import step2_generate_image_descriptions
+
+PANELS = [
+    {
+        "panel_number": 1,
+        "scene_description": "清晨的港口，渔船陆续出海，海鸥在桅杆之间盘旋",
+        "characters": ["麟奈狸"],
+        "dialogue": [{"character": "麟奈狸", "line": "今天风真大。"}],
+    },
+    {
+        "panel_number": 2,
+        "scene_description": "夜晚的船舱里，油灯摇晃",
+        "characters": ["船长"],
+        "dialogue": [],
+    },
+]
+
+
+class _FakeTextClient:
+    def __init__(self):
+        self.calls = 0
+        self.last_token_count = None
+
+    def generate_text(self, prompt, response_schema=None):
+        self.calls += 1
+        self.last_token_count = 100 + self.calls
+        return f"image prompt #{self.calls}"
+
+
+@pytest.fixture
+def project_root(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "novel.txt").write_text("第一章 启程\n港口的清晨。\n", encoding="utf-8")
+    (tmp_path / "output").mkdir()
+    with (tmp_path / "output" / "comic_panels_draft.yaml").open("w", encoding="utf-8") as f:
+        yaml.safe_dump(PANELS, f, allow_unicode=True, sort_keys=False)
+    return tmp_path
+
+
+def _run_step2(project_root, monkeypatch, client):
+    monkeypatch.setattr(api_client, "_text_client_instance", client)
+    step2_generate_image_descriptions(project_root)
+    output = project_root / "output" / "generated_comic_data.json"
+    return json.loads(output.read_text(encoding="utf-8"))
+
+
+def test_step2_replays_recorded_descriptions_offline(project_root, monkeypatch, tmp_path):
+    cassette_path = tmp_path / "cassettes" / "step2.sqlite"
+
+    fake = _FakeTextClient()
+    recorder = Cassette(cassette_path, "record")
+    recorded = _run_step2(project_root, monkeypatch, RecordingTextClient(fake, recorder))
+    recorder.close()
+
+    assert fake.calls == 2
+    assert [p["generated_image_description"] for p in recorded] == ["image prompt #1", "image prompt #2"]
+
+    (project_root / "output" / "generated_comic_data.json").unlink()
+    replayer = ReplayTextClient(Cassette(cassette_path, "replay"))
+    replayed = _run_step2(project_root, monkeypatch, replayer)
+
+    assert replayed == recorded
+    assert replayer.last_token_count == 102
@@ -0,0 +1,154 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from src import thumbnails
+from src.thumbnails import (
+    THUMBNAIL_LEVELS,
+    build_contact_sheet,
+    build_thumbnail_pyramid,
+    collect_panel_images,
+    default_cache_dir,
+    get_thumbnail_path,
+    source_hash,
+)
+from src.utils import load_image_thumbnail
+
+
+def _image(path, size=(2048, 1024), color=(200, 30, 30)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", size, color).save(path)
+    return path
+
+
+@pytest.fixture
+def hash_calls(monkeypatch):
+    calls = []
+    original = thumbnails._file_sha256
+
+    def counting(path):
+        calls.append(path)
+        return original(path)
+
+    monkeypatch.setattr(thumbnails, "_file_sha256", counting)
+    return calls
+
+
+def test_pyramid_levels(tmp_path):
+    source = _image(tmp_path / "panel_001.png")
+    paths = build_thumbnail_pyramid(source, tmp_path / "cache")
+
+    assert sorted(paths) == sorted(THUMBNAIL_LEVELS)
+    for level, path in paths.items():
+        with Image.open(path) as thumb:
+            assert max(thumb.size) == level
+            assert thumb.size == (level, level // 2)
+
+
+def test_small_images_are_not_upscaled(tmp_path):
+    source = _image(tmp_path / "small.png", size=(100, 80))
+    with Image.open(build_thumbnail_pyramid(source, tmp_path / "cache")[256]) as thumb:
+        assert thumb.size == (100, 80)
+
+
+def test_sidecar_hit_skips_rehash(tmp_path, hash_calls):
+    source = _image(tmp_path / "panel_001.png")
+    cache_dir = tmp_path / "cache"
+
+    sha = source_hash(source, cache_dir)
+    assert source_hash(source, cache_dir) == sha
+    assert len(hash_calls) == 1
+    assert len(list((cache_dir / "sources").rglob("*.json"))) == 1
+
+
+def test_touched_file_is_rehashed_but_not_rebuilt(tmp_path, hash_calls):
+    source = _image(tmp_path / "panel_001.png")
+    cache_dir = tmp_path / "cache"
+    thumb = build_thumbnail_pyramid(source, cache_dir)[256]
+    built_at = thumb.stat().st_mtime_ns
+
+    st = source.stat()
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10_000_000))
+    assert build_thumbnail_pyramid(source, cache_dir)[256] == thumb
+    assert len(hash_calls) == 2
+    assert thumb.stat().st_mtime_ns == built_at
+
+
+def test_changed_content_rebuilds(tmp_path):
+    source = _image(tmp_path / "panel_001.png")
+    cache_dir = tmp_path / "cache"
+    old = build_thumbnail_pyramid(source, cache_dir)[256]
+
+    _image(source, color=(30, 30, 200))
+    st = source.stat()
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10_000_000))
+    new = build_thumbnail_pyramid(source, cache_dir)[256]
+
+    assert new != old
+    with Image.open(new) as thumb:
+        assert thumb.getpixel((10, 10))[2] > 150
+
+
+def test_same_content_shares_thumbnails(tmp_path):
+    a = _image(tmp_path / "a.png")
+    b = _image(tmp_path / "b.png")
+    cache_dir = tmp_path / "cache"
+    assert build_thumbnail_pyramid(a, cache_dir) == build_thumbnail_pyramid(b, cache_dir)
+
+
+def test_corrupt_sidecar_is_ignored(tmp_path, hash_calls):
+    source = _image(tmp_path / "panel_001.png")
+    cache_dir = tmp_path / "cache"
+    sha = source_hash(source, cache_dir)
+    for sidecar in (cache_dir / "sources").rglob("*.json"):
+        sidecar.write_text("{not json", encoding="utf-8")
+
+    assert source_hash(source, cache_dir) == sha
+    assert len(hash_calls) == 2
+
+
+def test_extra_level_on_demand(tmp_path):
+    source = _image(tmp_path / "panel_001.png")
+    with Image.open(get_thumbnail_path(source, 128, tmp_path / "cache")) as thumb:
+        assert thumb.size == (128, 64)
+
+
+def test_contact_sheet_layout(tmp_path):
+    images = [_image(tmp_path / f"panel_{i:03d}.png", color=(i * 60, 0, 0)) for i in range(1, 4)]
+    sheet_path = build_contact_sheet(images, tmp_path / "sheet.jpg", tmp_path / "cache", columns=2, padding=8)
+
+    with Image.open(sheet_path) as sheet:
+        # 2 列 x 2 行，每格 256 + 8
+        assert sheet.size == (2 * 264 + 8, 2 * 264 + 8)
+
+    with pytest.raises(ValueError):
+        build_contact_sheet([], tmp_path / "empty.jpg", tmp_path / "cache")
+
+
+def test_collect_panel_images(tmp_path):
+    images_dir = tmp_path / "output" / "comic_images"
+    _image(images_dir / "panel_002.png", size=(8, 8))
+    _image(images_dir / "panel_001.png", size=(8, 8))
+    assert [p.name for p in collect_panel_images(tmp_path)] == ["panel_001.png", "panel_002.png"]
+
+    final = [
+        {"panel_number": 1, "generated_image_path": "output/comic_images/panel_002.png"},
+        {"panel_number": 2},
+        {"panel_number": 3, "generated_image_path": "output/comic_images/missing.png"},
+        {"panel_number": 4, "generated_image_path": "output/comic_images/panel_001.png"},
+    ]
+    (tmp_path / "output" / "final_comic_data_with_images.json").write_text(json.dumps(final), encoding="utf-8")
+    assert [p.name for p in collect_panel_images(tmp_path)] == ["panel_002.png", "panel_001.png"]
+
+
+def test_load_image_thumbnail_default_cache_dir(tmp_path):
+    source = _image(tmp_path / "output" / "comic_images" / "panel_001.png")
+    with load_image_thumbnail(str(source)) as thumb:
+        assert max(thumb.size) == 512
+    assert default_cache_dir(tmp_path) == tmp_path / "output" / "thumbnails"
+    assert list((default_cache_dir(tmp_path) / "sources").rglob("*.json"))
+
+    with pytest.raises(FileNotFoundError):
+        load_image_thumbnail(str(tmp_path / "missing.png"))
@@ -0,0 +1,81 @@
+import time
+
+from src.work_queue import PanelWorkQueue
+
+
+def _panel(n, description="a quiet harbour at dawn"):
+    return {"panel_number": n, "scene_description": f"场景 {n}", "generated_image_description": description}
+
+
+def test_claim_complete_and_results(tmp_path):
+    queue = PanelWorkQueue(tmp_path / "queue.sqlite")
+    assert queue.enqueue([_panel(1), _panel(2), {"panel_number": 3}]) == (3, 0)
+    assert queue.counts()["skipped"] == 1
+
+    panel_number, panel = queue.claim("w1")
+    assert panel_number == 1 and panel["scene_description"] == "场景 1"
+    assert queue.complete(1, "w1", "output/comic_images/panel_001.png")
+
+    results = queue.results()
+    assert [p["panel_number"] for p in results] == [1, 2, 3]
+    assert results[0]["generated_image_path"] == "output/comic_images/panel_001.png"
+    assert "generated_image_path" not in results[1]
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    queue = PanelWorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.05)
+    queue.enqueue([_panel(1)])
+
+    assert queue.claim("w1")[0] == 1
+    assert queue.claim("w2") is None  # 租约还没过期
+
+    time.sleep(0.1)
+    assert queue.claim("w2")[0] == 1
+    # 原 worker 的租约已被接管：心跳和完成都不再生效
+    assert not queue.heartbeat(1, "w1")
+    assert not queue.complete(1, "w1", "stale.png")
+    assert queue.complete(1, "w2", "panel_001.png")
+    assert queue.counts()["done"] == 1
+
+
+def test_expired_lease_fails_after_max_attempts(tmp_path):
+    queue = PanelWorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.01, max_attempts=2)
+    queue.enqueue([_panel(1)])
+
+    assert queue.claim("w1") is not None
+    time.sleep(0.05)
+    assert queue.claim("w2") is not None
+    time.sleep(0.05)
+    assert queue.claim("w3") is None
+    assert queue.failures() == [(1, "lease expired")]
+
+
+def test_fail_retries_until_max_attempts(tmp_path):
+    queue = PanelWorkQueue(tmp_path / "queue.sqlite", max_attempts=2)
+    queue.enqueue([_panel(1)])
+
+    queue.claim("w1")
+    queue.fail(1, "w1", "boom")
+    assert queue.counts()["pending"] == 1
+
+    queue.claim("w1")
+    queue.fail(1, "w1", "boom")
+    assert queue.counts()["failed"] == 1
+    assert not queue.has_unfinished()
+
+
+def test_reenqueue_updates_changed_and_failed_panels(tmp_path):
+    queue = PanelWorkQueue(tmp_path / "queue.sqlite", max_attempts=1)
+    queue.enqueue([_panel(1), _panel(2), _panel(3)])
+
+    queue.claim("w1")
+    queue.complete(1, "w1", "panel_001.png")
+    queue.claim("w1")
+    queue.fail(2, "w1", "boom")
+
+    added, updated = queue.enqueue([_panel(1), _panel(2), _panel(3, "a stormy night"), _panel(4)])
+    assert (added, updated) == (1, 2)
+    counts = queue.counts()
+    assert counts["done"] == 1
+    assert counts["pending"] == 3
+    assert queue.failures() == []